@@ -1,7 +1,7 @@
 import streamlit as st
 from openai import OpenAI
+import httpx
 from pinecone import Pinecone
-from sentence_transformers import SentenceTransformer
 import streamlit.components.v1 as components
 import datetime
 import uuid
@@ -9,6 +9,24 @@ import time
 import json
 import random
 import re
+import os
+import threading
+import sqlite3
+import atexit
+import hashlib
+import numpy as np
+import io
+import codecs
+import bisect
+import heapq
+import zipfile
+import collections
+import itertools
+import contextlib
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, as_completed, FIRST_COMPLETED
+from vector_store import LocalVectorStore
+import ocr_worker
 
 # --- 1. 頁面設定 ---
 st.set_page_config(
@@ -63,21 +81,550 @@ st.markdown("""
 
 # --- 2. 初始化核心模型 ---
 @st.cache_resource
-def init_embedding_model():
-    return SentenceTransformer('all-MiniLM-L6-v2')
+def init_embedding_model(model_name):
+    return LazyEmbedder(model_name, EMBED_CACHE_PATH)
+
+@st.cache_resource(max_entries=8)
+def init_notes_index(notes_hash, _notes):
+    return NotesIndex(_notes)
+
+@st.cache_resource
+def init_llm_cache():
+    return LLMResponseCache(LLM_CACHE_PATH)
+
+@st.cache_resource
+def init_ocr_cache():
+    return TextCache(OCR_CACHE_PATH)
+
+@st.cache_resource
+def init_ingest_cache():
+    return TextCache(INGEST_CACHE_PATH)
+
+@st.cache_resource
+def init_llm_client(api_key, base_url):
+    # 全個程序共用一個 client (keep-alive 連線池)，每次 rerun 不再重新建立連線
+    http_client = httpx.Client(limits=httpx.Limits(max_connections=LLM_MAX_CONCURRENCY * 2,
+                                                   max_keepalive_connections=LLM_MAX_CONCURRENCY),
+                               timeout=httpx.Timeout(120.0, connect=10.0))
+    return OpenAI(api_key=api_key, base_url=base_url, http_client=http_client)
+
+@st.cache_resource
+def init_llm_slots():
+    return threading.BoundedSemaphore(LLM_MAX_CONCURRENCY)
 
 @st.cache_resource
 def init_pinecone(api_key):
     return Pinecone(api_key=api_key)
 
-with st.spinner("正在啟動雲端連線..."):
-    embed_model = init_embedding_model()
+@st.cache_resource
+def init_pinecone_index(api_key, index_name):
+    return init_pinecone(api_key).Index(index_name)
+
+@st.cache_resource
+def init_local_store(root):
+    return LocalVectorStore(root)
+
+@st.cache_resource
+def init_write_queue(backend_key, _idx):
+    queue = WriteBehindQueue(_idx)
+    atexit.register(queue.flush)
+    return queue
+
+@st.cache_resource(max_entries=32)   # 每個學生 namespace 一份；太久沒用的會被移除 (之後由磁碟重新載入)
+def init_deck_mirror(backend, namespace):
+    return DeckMirror(os.path.join(DECK_CACHE_DIR, backend, namespace or "_default"))
 
 # --- 3. API Key 設定 ---
 deepseek_key = st.secrets.get("DEEPSEEK_API_KEY")
+deepseek_base_url = st.secrets.get("DEEPSEEK_BASE_URL", "https://api.deepseek.com")
 pinecone_key = st.secrets.get("PINECONE_API_KEY")
 
 # --- 4. 核心函數 ---
+LATEX_BLOCK_RE = re.compile(r'\\\[(.*?)\\\]', re.DOTALL)
+LATEX_INLINE_RE = re.compile(r'\\\((.*?)\\\)', re.DOTALL)
+DISPLAY_MATH_RE = re.compile(r'(\$\$.*?\$\$)', re.DOTALL)
+RENDER_CACHE_SIZE = 512       # render_segments 快取的內容數量
+CHAT_HISTORY_VISIBLE = 20     # 問答頁預設只顯示最近 N 則訊息
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+DECK_CACHE_DIR = os.path.join(APP_DIR, ".deck_cache")
+LOCAL_STORE_DIR = os.path.join(APP_DIR, ".local_store")
+STORAGE_BACKENDS = ["☁️ Pinecone", "💻 本地"]
+DEFAULT_EMBED_MODEL = 'all-MiniLM-L6-v2'
+EMBED_MODEL_NAME = st.secrets.get("EMBED_MODEL", DEFAULT_EMBED_MODEL)   # 更換模型前先用「遷移題庫」重新編碼
+EMBED_CACHE_PATH = os.path.join(APP_DIR, ".embed_cache", "embeddings.sqlite")
+PERF_MAX_SPANS = 2000         # 每個 session 保留最近 N 個計時 span
+
+class PerfTracer:
+    """
+    效能追蹤 (每個 session 一個，存於 session_state)：
+    span() 記錄 encode / Pinecone / DeepSeek 等呼叫的延遲、資料量、token 用量及快取命中，
+    begin_rerun / end_rerun 記錄整次 rerun 的時間；可匯出為 JSONL
+    """
+    def __init__(self, max_spans=PERF_MAX_SPANS):
+        self.session_id = uuid.uuid4().hex[:12]
+        self.spans = collections.deque(maxlen=max_spans)
+        self.lock = threading.Lock()
+        self.rerun = 0
+        self._rerun_start = None
+
+    def _record(self, rec):
+        with self.lock:
+            self.spans.append(rec)
+
+    @contextlib.contextmanager
+    def span(self, name, **attrs):
+        """with tracer.span("pinecone.query", top_k=10) as rec: ... ；可在區塊內把結果資料寫入 rec"""
+        rec = {"name": name, "rerun": self.rerun, "ts": time.time(), "thread": threading.current_thread().name}
+        rec.update(attrs)
+        t0 = time.perf_counter()
+        try:
+            yield rec
+        except BaseException as e:
+            if not isinstance(e, GeneratorExit):
+                rec["error"] = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            rec["ms"] = round((time.perf_counter() - t0) * 1000, 2)
+            self._record(rec)
+
+    @staticmethod
+    def elapsed_ms(rec):
+        """span 開始至今的毫秒數 (例如等候並發名額、首個 token 的時間)"""
+        return round((time.time() - rec["ts"]) * 1000, 2)
+
+    def begin_rerun(self):
+        self.rerun += 1
+        self._rerun_start = (time.time(), time.perf_counter())
+
+    def end_rerun(self):
+        if self._rerun_start is None:
+            return
+        ts, t0 = self._rerun_start
+        self._rerun_start = None
+        self._record({"name": "streamlit.rerun", "rerun": self.rerun, "ts": ts, "thread": threading.current_thread().name,
+                      "ms": round((time.perf_counter() - t0) * 1000, 2)})
+
+    def summary(self):
+        """按 span 名稱統計：次數、p50 / p95 / 最長延遲、錯誤數、token 用量及快取命中"""
+        with self.lock:
+            spans = list(self.spans)
+        groups = {}
+        for rec in spans:
+            groups.setdefault(rec["name"], []).append(rec)
+        rows = []
+        for name, recs in sorted(groups.items()):
+            ms = sorted(r["ms"] for r in recs)
+            cached = [r["cache"] for r in recs if r.get("cache") in ("hit", "miss")]
+            hits = cached.count("hit") + sum(r.get("cache_hits", 0) for r in recs)
+            lookups = len(cached) + sum(r.get("texts", 0) for r in recs)
+            rows.append({
+                "span": name, "次數": len(recs),
+                "p50 ms": ms[len(ms) // 2], "p95 ms": ms[min(len(ms) - 1, int(len(ms) * 0.95))], "最長 ms": ms[-1],
+                "錯誤": sum(1 for r in recs if "error" in r),
+                "tokens": sum(r.get("prompt_tokens", 0) + r.get("completion_tokens", 0) for r in recs),
+                "快取命中": f"{hits}/{lookups}" if lookups else "",
+            })
+        return rows
+
+    def to_jsonl(self):
+        with self.lock:
+            spans = list(self.spans)
+        return "".join(json.dumps(dict(rec, session=self.session_id), ensure_ascii=False) + "\n" for rec in spans)
+
+    def clear(self):
+        with self.lock:
+            self.spans.clear()
+
+class LazyEmbedder:
+    """
+    延遲載入的 embedding 模型 (介面同 SentenceTransformer.encode)：
+    sentence_transformers / torch 只在第一次 encode 時才 import 及載入，
+    結果按文字的 hash 存入 SQLite，相同文字不會重複計算
+    """
+    def __init__(self, model_name, cache_path):
+        self.model_name = model_name
+        self._model = None
+        self._load_lock = threading.Lock()
+        self._warming = False
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        self.db_lock = threading.Lock()
+        self.db = sqlite3.connect(cache_path, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL)")
+        self.db.commit()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def loaded(self):
+        return self._model is not None
+
+    def _load(self):
+        with self._load_lock:
+            if self._model is None:
+                from sentence_transformers import SentenceTransformer
+                self._model = SentenceTransformer(self.model_name)
+        return self._model
+
+    def warm(self):
+        """在背景線程預先載入模型 (例如即將出現「加入題庫」按鈕時)"""
+        if self._model is None and not self._warming:
+            self._warming = True
+            threading.Thread(target=self._load, daemon=True, name="embed-warmup").start()
+
+    def _key(self, text):
+        return hashlib.sha256(f"{self.model_name}\0{text}".encode('utf-8')).hexdigest()
+
+    def encode(self, sentences, batch_size=32, stats=None, **kwargs):
+        """stats (dict)：傳入時寫入本次的 texts / cache_hits 數量"""
+        single = isinstance(sentences, str)
+        texts = [sentences] if single else list(sentences)
+        keys = [self._key(t) for t in texts]
+        found = {}
+        uniq_keys = list(dict.fromkeys(keys))
+        with self.db_lock:
+            for i in range(0, len(uniq_keys), 500):
+                part = uniq_keys[i:i + 500]
+                rows = self.db.execute(f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(part))})", part)
+                for key, blob in rows:
+                    found[key] = np.frombuffer(blob, dtype=np.float32)
+        todo = {}
+        for key, text in zip(keys, texts):
+            if key not in found:
+                todo.setdefault(key, text)
+        n_hits = len(texts) - sum(1 for k in keys if k in todo)
+        self.hits += n_hits
+        self.misses += len(todo)
+        if stats is not None:
+            stats.update(texts=len(texts), cache_hits=n_hits)
+        if todo:
+            vectors = self._load().encode(list(todo.values()), batch_size=batch_size, convert_to_numpy=True, **kwargs)
+            vectors = np.asarray(vectors, dtype=np.float32)
+            with self.db_lock:
+                self.db.executemany("INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)",
+                                    [(key, vec.tobytes()) for key, vec in zip(todo, vectors)])
+                self.db.commit()
+            found.update(zip(todo, vectors))
+        out = np.stack([found[k] for k in keys])
+        return out[0] if single else out
+
+
+PINECONE_INDEX_NAME = st.secrets.get("PINECONE_INDEX", "dse-memory")
+
+def student_namespace(student_id):
+    """每位學生一個 namespace (以代號的 hash 命名)；未填代號時使用預設 namespace"""
+    student_id = (student_id or "").strip().lower()
+    if not student_id:
+        return ""
+    return "student-" + hashlib.sha256(student_id.encode('utf-8')).hexdigest()[:16]
+
+class NamespacedIndex:
+    """
+    把 namespace 自動帶入每次 Index 呼叫 (Pinecone Index 與 LocalVectorStore 通用)；
+    有 tracer 時每次呼叫都記錄為 index.* span
+    """
+    def __init__(self, idx, namespace, tracer=None):
+        self.idx = idx
+        self.namespace = namespace
+        self.tracer = tracer
+
+    def _span(self, name, **attrs):
+        return self.tracer.span(f"index.{name}", **attrs) if self.tracer else contextlib.nullcontext({})
+
+    def upsert(self, vectors, **kwargs):
+        with self._span("upsert", items=len(vectors)):
+            return self.idx.upsert(vectors=vectors, namespace=self.namespace, **kwargs)
+
+    def update(self, id, **kwargs):
+        with self._span("update"):
+            return self.idx.update(id=id, namespace=self.namespace, **kwargs)
+
+    def delete(self, ids=None, **kwargs):
+        with self._span("delete", items=len(ids or ())):
+            return self.idx.delete(ids=ids, namespace=self.namespace, **kwargs)
+
+    def query(self, **kwargs):
+        with self._span("query", top_k=kwargs.get('top_k')) as rec:
+            res = self.idx.query(namespace=self.namespace, **kwargs)
+            rec["matches"] = len(res['matches'])
+            return res
+
+    def fetch(self, ids, **kwargs):
+        with self._span("fetch", items=len(ids)) as rec:
+            res = self.idx.fetch(ids=ids, namespace=self.namespace, **kwargs)
+            rec["found"] = len(res.vectors)
+            return res
+
+    def list_paginated(self, **kwargs):
+        with self._span("list") as rec:
+            page = self.idx.list_paginated(namespace=self.namespace, **kwargs)
+            rec["items"] = len(page.vectors)
+            return page
+
+    def __getattr__(self, name):
+        return getattr(self.idx, name)
+
+LIST_PAGE_SIZE = 100     # Pinecone list 每頁上限
+FETCH_BATCH_SIZE = 100   # 每次 fetch 的 ID 數量
+CHANGES_TOP_K = 1000     # 增量同步時，單次查詢已修改紀錄的上限 (達上限即改為 fetch 全部)
+SYNC_OVERLAP = 30.0      # 秒：增量同步往前多查的時間，涵蓋寫入請求途中及 Pinecone 索引更新的延遲
+
+def list_all_ids(idx):
+    """分頁列出 index (namespace) 內所有卡片 ID"""
+    ids = set()
+    token = None
+    while True:
+        page = idx.list_paginated(limit=LIST_PAGE_SIZE, pagination_token=token)
+        ids.update(v.id for v in page.vectors)
+        token = page.pagination.next if page.pagination else None
+        if not token:
+            return ids
+
+MIRROR_LOG_FILE = "changes.log"
+MIRROR_LOG_COMPACT_LINES = 2000   # 修改紀錄累積到此行數就寫回各科檔案
+
+class DeckMirror:
+    """
+    題庫本地鏡像：按學科分檔存於磁碟 ({subject}.json)，
+    每科記錄最後同步時間，同步時只拉取新增 / 修改過的卡片；
+    按鈕造成的單張修改只附加到 changes.log，同步時 (或紀錄過長時) 才寫回各科檔案；
+    另按學科維護已排序的到期時間索引，計算「今日到期」毋須掃描所有卡片
+    """
+    def __init__(self, root):
+        self.root = root
+        self.lock = threading.RLock()
+        self.subjects = {}  # subject -> {"last_sync": float, "cards": {id: metadata}}
+        self.owner = {}     # id -> subject
+        self.due = {}       # subject -> sorted [(due, id)]
+        self.dirty = set()     # 有修改尚未寫回檔案的學科
+        self.unlogged = False  # 有 persist=False 的修改 (未寫入 changes.log)
+        self.log_lines = 0
+        if os.path.isdir(root):
+            for fn in os.listdir(root):
+                if not fn.endswith('.json'):
+                    continue
+                try:
+                    with open(os.path.join(root, fn), encoding='utf-8') as fp:
+                        data = json.load(fp)
+                except (OSError, ValueError):
+                    continue
+                subject = data.get('subject')
+                if not subject:
+                    continue
+                self.subjects[subject] = data
+                for cid in data.get('cards', {}):
+                    self.owner[cid] = subject
+                self.due[subject] = sorted((md['due'], cid) for cid, md in data.get('cards', {}).items() if 'due' in md)
+        self._replay_log()
+
+    def _log_path(self):
+        return os.path.join(self.root, MIRROR_LOG_FILE)
+
+    def _replay_log(self):
+        """把上次寫回後的修改紀錄套用到各科資料 (紀錄可重複套用)"""
+        try:
+            with open(self._log_path(), encoding='utf-8') as fp:
+                lines = fp.readlines()
+        except OSError:
+            return
+        for line in lines:
+            try:
+                rec = json.loads(line)
+            except ValueError:
+                continue   # 寫到一半的最後一行
+            if rec['op'] == 'put':
+                self.put(rec['id'], rec['metadata'], persist=False)
+            elif rec['op'] == 'patch':
+                self.patch(rec['id'], rec['fields'], persist=False)
+            elif rec['op'] == 'drop':
+                self.drop(rec['ids'], persist=False)
+        self.unlogged = False
+        self.log_lines = len(lines)
+
+    def _persist(self, record, subjects):
+        """單張修改：附加一行到 changes.log；之前有未記錄的批次修改或紀錄過長時改為寫回檔案"""
+        self.dirty |= subjects
+        if self.unlogged or self.log_lines >= MIRROR_LOG_COMPACT_LINES:
+            self._save(())
+            return
+        os.makedirs(self.root, exist_ok=True)
+        with open(self._log_path(), 'a', encoding='utf-8') as fp:
+            fp.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self.log_lines += 1
+
+    def _path(self, subject):
+        safe = re.sub(r'[^\w\-]', '_', subject)
+        return os.path.join(self.root, f"{safe}.json")
+
+    def _bucket(self, subject):
+        if subject not in self.subjects:
+            self.subjects[subject] = {"subject": subject, "last_sync": 0.0, "cards": {}}
+        return self.subjects[subject]
+
+    def _save(self, subjects):
+        """寫回 subjects 及所有有未寫回修改的學科，然後清空 changes.log"""
+        os.makedirs(self.root, exist_ok=True)
+        for subject in set(subjects) | self.dirty:
+            if subject not in self.subjects:
+                continue
+            path = self._path(subject)
+            tmp = f"{path}.{os.getpid()}.tmp"
+            with open(tmp, 'w', encoding='utf-8') as fp:
+                json.dump(self.subjects[subject], fp, ensure_ascii=False)
+            os.replace(tmp, path)
+        if self.log_lines and os.path.exists(self._log_path()):
+            os.remove(self._log_path())
+        self.dirty.clear()
+        self.unlogged = False
+        self.log_lines = 0
+
+    def _index_due(self, subject, card_id, metadata):
+        if metadata and 'due' in metadata:
+            bisect.insort(self.due.setdefault(subject, []), (metadata['due'], card_id))
+
+    def _unindex_due(self, subject, card_id, metadata):
+        if metadata and 'due' in metadata:
+            entries = self.due.get(subject, [])
+            i = bisect.bisect_left(entries, (metadata['due'], card_id))
+            if i < len(entries) and entries[i] == (metadata['due'], card_id):
+                del entries[i]
+
+    def due_count(self, subject=None, until=None):
+        """到期時間 <= until 的卡片數量 (二分搜尋)"""
+        until = time.time() if until is None else until
+        with self.lock:
+            subjects = [subject] if subject else list(self.due)
+            return sum(bisect.bisect_right(self.due.get(s, []), (until, '\uffff')) for s in subjects)
+
+    def cards(self, subject=None):
+        """回傳 [{"id", "metadata"}]，subject 為 None 時回傳全部"""
+        with self.lock:
+            buckets = [self.subjects[subject]] if subject in self.subjects else ([] if subject else list(self.subjects.values()))
+            return [{"id": cid, "metadata": md} for b in buckets for cid, md in b['cards'].items()]
+
+    def get(self, card_id):
+        with self.lock:
+            subject = self.owner.get(card_id)
+            return self.subjects[subject]['cards'].get(card_id) if subject else None
+
+    def put(self, card_id, metadata, persist=True):
+        with self.lock:
+            touched = {metadata.get('subject', 'Unknown')}
+            old = self.owner.get(card_id)
+            if old:
+                self._unindex_due(old, card_id, self.subjects[old]['cards'].pop(card_id, None))
+                touched.add(old)
+            subject = metadata.get('subject', 'Unknown')
+            self._bucket(subject)['cards'][card_id] = dict(metadata)
+            self._index_due(subject, card_id, metadata)
+            self.owner[card_id] = subject
+            if persist:
+                self._persist({"op": "put", "id": card_id, "metadata": metadata}, touched)
+            else:
+                self.dirty |= touched
+                self.unlogged = True
+
+    def put_many(self, items):
+        """批次加入 / 取代多張卡 [(id, metadata)]，完成後一次寫回受影響的學科"""
+        with self.lock:
+            for card_id, metadata in items:
+                self.put(card_id, metadata, persist=False)
+            if self.dirty:
+                self._save(())
+
+    def patch(self, card_id, fields, persist=True):
+        with self.lock:
+            md = self.get(card_id)
+            if md is None:
+                return
+            subject = self.owner[card_id]
+            self._unindex_due(subject, card_id, md)
+            md.update(fields)
+            self._index_due(subject, card_id, md)
+            if persist:
+                self._persist({"op": "patch", "id": card_id, "fields": fields}, {subject})
+            else:
+                self.dirty.add(subject)
+                self.unlogged = True
+
+    def drop(self, card_ids, persist=True):
+        with self.lock:
+            touched = set()
+            for cid in card_ids:
+                subject = self.owner.pop(cid, None)
+                if subject:
+                    self._unindex_due(subject, cid, self.subjects[subject]['cards'].pop(cid, None))
+                    touched.add(subject)
+            if not touched:
+                return
+            if persist:
+                self._persist({"op": "drop", "ids": list(card_ids)}, touched)
+            else:
+                self.dirty |= touched
+                self.unlogged = True
+
+    def sync(self, idx, subject=None, pending=()):
+        """
+        增量同步：
+        1. 分頁列出遠端所有 ID，刪走本地多出的，fetch 本地未有的
+        2. 以 timestamp 過濾查詢上次同步 (減 SYNC_OVERLAP) 後被修改過的卡片；
+           結果達 CHANGES_TOP_K 上限 (可能有遺漏) 時改為 fetch 所有已知卡片，確保 last_sync 之前的修改全部拉取
+        pending：尚未寫入遠端的卡片 ID，同步時保留本地版本
+        """
+        started = time.time()
+        remote_ids = list_all_ids(idx)
+
+        with self.lock:
+            stale = set(self.owner) - remote_ids - set(pending)
+            missing = [cid for cid in remote_ids if cid not in self.owner]
+            known_subjects = [subject] if subject else list(self.subjects)
+            since = min((self.subjects[s]['last_sync'] for s in known_subjects if s in self.subjects), default=0.0)
+
+        fetched = {}
+        for i in range(0, len(missing), FETCH_BATCH_SIZE):
+            res = idx.fetch(ids=missing[i:i + FETCH_BATCH_SIZE])
+            for cid, vec in res.vectors.items():
+                fetched[cid] = dict(vec.metadata or {})
+
+        # 已存在的卡片只拉取 timestamp 比上次同步新的紀錄 (查詢只靠 filter，向量用與 index 同維度的零向量)
+        dim = idx.describe_index_stats().dimension if since and remote_ids else None
+        if dim:
+            meta_filter = {"timestamp": {"$gt": since - SYNC_OVERLAP}}
+            if subject:
+                meta_filter["subject"] = subject
+            res = idx.query(vector=[0.0] * dim, top_k=CHANGES_TOP_K, include_metadata=True, filter=meta_filter)
+            if len(res['matches']) >= CHANGES_TOP_K:
+                rest = [cid for cid in remote_ids if cid not in fetched and cid not in pending]
+                for i in range(0, len(rest), FETCH_BATCH_SIZE):
+                    res_batch = idx.fetch(ids=rest[i:i + FETCH_BATCH_SIZE])
+                    for cid, vec in res_batch.vectors.items():
+                        fetched[cid] = dict(vec.metadata or {})
+            else:
+                for m in res['matches']:
+                    if m['id'] in remote_ids and m['id'] not in fetched and m['id'] not in pending:
+                        fetched[m['id']] = dict(m['metadata'] or {})
+
+        with self.lock:
+            touched = {self.owner[cid] for cid in stale if cid in self.owner}
+            self.drop(stale, persist=False)
+            changed = 0
+            for cid, md in fetched.items():
+                if self.get(cid) == md:
+                    continue   # 全量 fetch 時大部分卡片沒有改變
+                changed += 1
+                new_subject = md.get('subject', 'Unknown')
+                if new_subject not in self.subjects:
+                    # 新出現的學科：所有卡片都是剛拉取的，視為已同步
+                    self._bucket(new_subject)['last_sync'] = started
+                touched.add(new_subject)
+                if cid in self.owner:
+                    touched.add(self.owner[cid])
+                self.put(cid, md, persist=False)
+            for s in ([subject] if subject else list(self.subjects)):
+                self._bucket(s)['last_sync'] = started
+                touched.add(s)
+            self._save(touched)
+        return changed, len(stale)
+
 def clean_latex(text):
     """
     修正 LaTeX 格式，將 \[ \] 轉換為 $$ $$，\( \) 轉換為 $ $
@@ -87,20 +634,496 @@ def clean_latex(text):
         return ""
     
     # 簡單的替換，處理常見的 LaTeX 轉義
-    text = re.sub(r'\\\[(.*?)\\\]', r'$$\1$$', text, flags=re.DOTALL)
-    text = re.sub(r'\\\((.*?)\\\)', r'$\1$', text, flags=re.DOTALL)
+    text = LATEX_BLOCK_RE.sub(r'$$\1$$', text)
+    text = LATEX_INLINE_RE.sub(r'$\1$', text)
     
     return text
 
-def manual_save_to_cloud(subject, question, answer, note_type):
+@st.cache_data(max_entries=RENDER_CACHE_SIZE, show_spinner=False)
+def render_segments(text):
+    """clean_latex 後按 $$...$$ 切段，回傳 (("latex" | "md", 內容), ...)；按內容快取"""
+    cleaned = clean_latex(text)
+    if '$$' not in cleaned:
+        return (("md", cleaned),) if cleaned.strip() else ()
+    segments = []
+    for part in DISPLAY_MATH_RE.split(cleaned):
+        if len(part) >= 4 and part.startswith('$$') and part.endswith('$$'):
+            segments.append(("latex", part[2:-2]))
+        elif part.strip():
+            segments.append(("md", part))
+    return tuple(segments)
+
+def render_rich(segments, target=st, unsafe_allow_html=False):
+    """畫出 render_segments 的結果；target 可以是 st 或任何 container"""
+    for kind, body in segments:
+        if kind == "latex":
+            target.latex(body)
+        else:
+            target.markdown(body, unsafe_allow_html=unsafe_allow_html)
+
+def chat_message_segments(message):
+    """訊息的切段結果存於訊息本身，舊訊息在之後的 rerun 不用再處理"""
+    if 'segments' not in message:
+        message['segments'] = render_segments(message['content'])
+    return message['segments']
+
+WRITE_FLUSH_INTERVAL = 2.0   # 秒：背景寫入的最長等待時間
+WRITE_BATCH_SIZE = 100       # 累積多少筆修改就立即寫入
+WRITE_MAX_BACKOFF = 60.0     # 寫入失敗後重試的最長間隔
+WRITE_MAX_ATTEMPTS = 3       # 同一項修改被題庫拒絕 (不能靠重試解決) 多少次就放棄
+
+def is_permanent_write_error(e):
+    """重試也不會成功的寫入錯誤：資料不合規格 (ValueError / TypeError) 或 HTTP 4xx (408、429 除外)"""
+    if isinstance(e, (ValueError, TypeError)):
+        return True
+    status = getattr(e, 'status', None) or getattr(e, 'status_code', None)
+    return isinstance(status, int) and 400 <= status < 500 and status not in (408, 429)
+
+class WriteBehindQueue:
+    """
+    背景寫入佇列 (每個後端一個，全程序共用)：按鈕 callback 只更新本地狀態並排隊，
+    背景線程按時間或數量批次呼叫 upsert / update / delete；
+    待寫入的項目以 (namespace, id) 為鍵，同一張卡的多次修改會合併為一次。
+    按 namespace 分批寫入，批次被拒絕時逐項重試，一項壞資料不會阻塞其他修改；
+    暫時性錯誤 (網絡 / 5xx) 會退避重試，被拒絕 WRITE_MAX_ATTEMPTS 次的項目則放棄並記錄在 rejected
+    """
+    def __init__(self, idx):
+        self.idx = idx
+        self.cond = threading.Condition()
+        self.upserts = {}    # (namespace, id) -> (values, metadata)
+        self.updates = {}    # (namespace, id) -> set_metadata (已合併)
+        self.deletes = set() # {(namespace, id)}
+        self.flush_lock = threading.Lock()
+        self.failures = 0
+        self.errors = {}     # namespace -> 最近一次暫時性錯誤
+        self.attempts = {}   # (namespace, id) -> 被拒絕的次數
+        self.rejected = {}   # (namespace, id) -> 放棄寫入的原因
+        threading.Thread(target=self._run, daemon=True, name="write-behind").start()
+
+    def for_namespace(self, namespace):
+        return NamespacedQueue(self, namespace)
+
+    def pending(self, namespace=None):
+        with self.cond:
+            keys = itertools.chain(self.upserts, self.updates, self.deletes)
+            if namespace is None:
+                return sum(1 for _ in keys)
+            return sum(1 for ns, _ in keys if ns == namespace)
+
+    def pending_ids(self, namespace):
+        with self.cond:
+            return {cid for ns, cid in itertools.chain(self.upserts, self.updates) if ns == namespace}
+
+    def pending_upserts(self, namespace):
+        """尚未寫入遠端的新卡 {id: (values, metadata)} (副本)"""
+        with self.cond:
+            return {cid: (values, dict(md)) for (ns, cid), (values, md) in self.upserts.items() if ns == namespace}
+
+    def pending_deletes(self, namespace):
+        with self.cond:
+            return {cid for ns, cid in self.deletes if ns == namespace}
+
+    def rejected_items(self, namespace):
+        """已放棄寫入的修改 {id: 原因}"""
+        with self.cond:
+            return {cid: msg for (ns, cid), msg in self.rejected.items() if ns == namespace}
+
+    def clear_rejected(self, namespace):
+        with self.cond:
+            for key in [k for k in self.rejected if k[0] == namespace]:
+                del self.rejected[key]
+
+    def upsert(self, namespace, card_id, values, metadata):
+        key = (namespace, card_id)
+        with self.cond:
+            self.deletes.discard(key)
+            self.updates.pop(key, None)
+            self.upserts[key] = (values, dict(metadata))
+            self._maybe_wake()
+
+    def update(self, namespace, card_id, fields):
+        key = (namespace, card_id)
+        with self.cond:
+            if key in self.deletes:
+                return
+            if key in self.upserts:
+                self.upserts[key][1].update(fields)
+            else:
+                self.updates.setdefault(key, {}).update(fields)
+            self._maybe_wake()
+
+    def delete(self, namespace, card_id):
+        key = (namespace, card_id)
+        with self.cond:
+            self.upserts.pop(key, None)
+            self.updates.pop(key, None)
+            self.deletes.add(key)
+            self._maybe_wake()
+
+    def _maybe_wake(self):
+        if len(self.upserts) + len(self.updates) + len(self.deletes) >= WRITE_BATCH_SIZE:
+            self.cond.notify()
+
+    def _requeue(self, upserts, updates, deletes):
+        """寫入失敗：放回佇列，但不覆蓋期間新排隊的修改"""
+        with self.cond:
+            for key, item in upserts.items():
+                if key not in self.deletes:
+                    self.upserts.setdefault(key, item)
+            for key, fields in updates.items():
+                if key in self.deletes:
+                    continue
+                if key in self.upserts:
+                    merged = dict(fields)
+                    merged.update(self.upserts[key][1])
+                    self.upserts[key] = (self.upserts[key][0], merged)
+                else:
+                    merged = dict(fields)
+                    merged.update(self.updates.get(key, {}))
+                    self.updates[key] = merged
+            for key in deletes:
+                if key not in self.upserts:
+                    self.deletes.add(key)
+
+    def _attempt(self, ns, keys, write, failed, down):
+        """
+        寫入一組 keys (一次呼叫)；被拒絕時逐項重試找出壞資料。
+        失敗的項目記錄在 failed[key] = 錯誤，發生暫時性錯誤的 namespace 記錄在 down，本輪不再寫入
+        """
+        if ns in down:
+            failed.update((key, down[ns]) for key in keys)
+            return
+        try:
+            write(keys)
+            return
+        except Exception as e:
+            if not is_permanent_write_error(e):
+                down[ns] = e
+                failed.update((key, e) for key in keys)
+                return
+            if len(keys) == 1:
+                failed[keys[0]] = e
+                return
+        for key in keys:
+            self._attempt(ns, [key], write, failed, down)
+
+    def flush(self):
+        """立即寫入所有 namespace 待處理的修改，全部成功回傳 True"""
+        with self.flush_lock:
+            with self.cond:
+                upserts, self.upserts = self.upserts, {}
+                updates, self.updates = self.updates, {}
+                deletes, self.deletes = self.deletes, set()
+            if not (upserts or updates or deletes):
+                return True
+            failed, down = {}, {}
+            by_namespace = collections.defaultdict(lambda: ([], [], []))
+            for key in upserts:
+                by_namespace[key[0]][0].append(key)
+            for key in updates:
+                by_namespace[key[0]][1].append(key)
+            for key in sorted(deletes):
+                by_namespace[key[0]][2].append(key)
+            for ns, (u_keys, p_keys, d_keys) in by_namespace.items():
+                # timestamp 以實際寫入的時間為準：排隊時 (按鈕按下) 的時間可能早於其他裝置上次同步
+                def write_upserts(keys, ns=ns):
+                    now = time.time()
+                    self.idx.upsert(vectors=[(k[1], upserts[k][0], {**upserts[k][1], "timestamp": now}) for k in keys], namespace=ns)
+
+                def write_update(keys, ns=ns):
+                    self.idx.update(id=keys[0][1], set_metadata={**updates[keys[0]], "timestamp": time.time()}, namespace=ns)
+
+                def write_deletes(keys, ns=ns):
+                    self.idx.delete(ids=[k[1] for k in keys], namespace=ns)
+
+                for i in range(0, len(u_keys), WRITE_BATCH_SIZE):
+                    self._attempt(ns, u_keys[i:i + WRITE_BATCH_SIZE], write_upserts, failed, down)
+                for key in p_keys:
+                    self._attempt(ns, [key], write_update, failed, down)
+                for i in range(0, len(d_keys), WRITE_BATCH_SIZE):
+                    self._attempt(ns, d_keys[i:i + WRITE_BATCH_SIZE], write_deletes, failed, down)
+
+            retry_upserts, retry_updates, retry_deletes = {}, {}, set()
+            with self.cond:
+                for key in itertools.chain(upserts, updates, deletes):
+                    error = failed.get(key)
+                    if error is None:
+                        self.attempts.pop(key, None)
+                        continue
+                    if is_permanent_write_error(error):
+                        self.attempts[key] = self.attempts.get(key, 0) + 1
+                        if self.attempts[key] >= WRITE_MAX_ATTEMPTS:
+                            del self.attempts[key]
+                            self.rejected[key] = str(error)
+                            continue
+                    if key in upserts:
+                        retry_upserts[key] = upserts[key]
+                    elif key in updates:
+                        retry_updates[key] = updates[key]
+                    else:
+                        retry_deletes.add(key)
+                for ns in by_namespace:
+                    if ns in down:
+                        self.errors[ns] = str(down[ns])
+                    else:
+                        self.errors.pop(ns, None)
+            self._requeue(retry_upserts, retry_updates, retry_deletes)
+            # 只有暫時性錯誤才需要退避；被拒絕的項目按正常間隔重試
+            self.failures = self.failures + 1 if down else 0
+            return not failed
+
+    def _run(self):
+        while True:
+            with self.cond:
+                delay = min(WRITE_FLUSH_INTERVAL * (2 ** self.failures), WRITE_MAX_BACKOFF)
+                self.cond.wait(timeout=delay)
+            self.flush()
+
+class NamespacedQueue:
+    """把 namespace 自動帶入共用 WriteBehindQueue 的每次呼叫 (與 NamespacedIndex 對應)"""
+    def __init__(self, queue, namespace):
+        self.queue = queue
+        self.namespace = namespace
+
+    @property
+    def last_error(self):
+        return self.queue.errors.get(self.namespace)
+
+    def pending(self):
+        return self.queue.pending(self.namespace)
+
+    def pending_ids(self):
+        return self.queue.pending_ids(self.namespace)
+
+    def pending_upserts(self):
+        return self.queue.pending_upserts(self.namespace)
+
+    def pending_deletes(self):
+        return self.queue.pending_deletes(self.namespace)
+
+    def rejected_items(self):
+        return self.queue.rejected_items(self.namespace)
+
+    def clear_rejected(self):
+        self.queue.clear_rejected(self.namespace)
+
+    def upsert(self, card_id, values, metadata):
+        self.queue.upsert(self.namespace, card_id, values, metadata)
+
+    def update(self, card_id, fields):
+        self.queue.update(self.namespace, card_id, fields)
+
+    def delete(self, card_id):
+        self.queue.delete(self.namespace, card_id)
+
+    def flush(self):
+        return self.queue.flush()
+
+NO_REPEAT_WINDOW = 5     # 最近抽過的 N 張卡不會重複出現
+
+class WeightedCardSampler:
+    """
+    以 Fenwick tree 儲存每張卡的權重：
+    抽卡、改權重、加卡、刪卡皆為 O(log n)，不需重建整個權重列表或重新拉取題庫；
+    另以 heap 按到期時間 (due) 排列已排程的卡片，到期卡片優先出現；
+    已排程的卡在樹中的權重為 0 (不參與按權重抽卡)，未到期前不會被抽出
+    """
+    def __init__(self, cards):
+        self.cards = list(cards)
+        self.pos = {c['id']: i for i, c in enumerate(self.cards)}
+        self.weights = [max(float(c['metadata'].get('weight', 20.0)), 0.0) for c in self.cards]
+        self.scheduled = {i for i, c in enumerate(self.cards) if 'due' in c['metadata']}
+        self.due_heap = [(c['metadata']['due'], c['id']) for c in self.cards if 'due' in c['metadata']]
+        heapq.heapify(self.due_heap)
+        self.tree = [0.0] * (len(self.weights) + 1)
+        for i, w in enumerate(self.weights, 1):
+            self.tree[i] += 0.0 if i - 1 in self.scheduled else w
+            parent = i + (i & -i)
+            if parent <= len(self.weights):
+                self.tree[parent] += self.tree[i]
+
+    def __len__(self):
+        return len(self.pos)
+
+    def _add(self, i, delta):
+        i += 1
+        while i < len(self.tree):
+            self.tree[i] += delta
+            i += i & -i
+
+    def _prefix(self, n):
+        total = 0.0
+        while n > 0:
+            total += self.tree[n]
+            n -= n & -n
+        return total
+
+    def _find(self, r):
+        """回傳第一個前綴和 > r 的葉子位置"""
+        pos, step = 0, 1 << (len(self.weights).bit_length())
+        while step:
+            nxt = pos + step
+            if nxt < len(self.tree) and self.tree[nxt] <= r:
+                pos = nxt
+                r -= self.tree[nxt]
+            step >>= 1
+        return min(pos, len(self.weights) - 1)
+
+    def get(self, card_id):
+        i = self.pos.get(card_id)
+        return self.cards[i] if i is not None else None
+
+    def add(self, card):
+        if card['id'] in self.pos:
+            # 已在池中 (重新匯入 / 還原)：換成新的 metadata
+            self.cards[self.pos[card['id']]] = card
+            self.set_weight(card['id'], float(card['metadata'].get('weight', 20.0)))
+            if 'due' in card['metadata']:
+                self.reschedule(card['id'], card['metadata']['due'])
+            return
+        n = len(self.weights) + 1
+        w = max(float(card['metadata'].get('weight', 20.0)), 0.0)
+        self.cards.append(card)
+        self.pos[card['id']] = n - 1
+        self.weights.append(w)
+        if 'due' in card['metadata']:
+            self.scheduled.add(n - 1)
+            heapq.heappush(self.due_heap, (card['metadata']['due'], card['id']))
+            w = 0.0
+        # 新節點覆蓋 (n - lowbit(n), n] 區間
+        self.tree.append(w + self._prefix(n - 1) - self._prefix(n - (n & -n)))
+
+    def set_weight(self, card_id, weight):
+        i = self.pos.get(card_id)
+        if i is None:
+            return
+        weight = max(float(weight), 0.0)
+        if i not in self.scheduled:
+            self._add(i, weight - self.weights[i])
+        self.weights[i] = weight
+
+    def remove(self, card_id):
+        i = self.pos.get(card_id)
+        if i is None:
+            return
+        self.set_weight(card_id, 0.0)
+        del self.pos[card_id]
+
+    def reschedule(self, card_id, due):
+        i = self.pos.get(card_id)
+        if i is None:
+            return
+        if i not in self.scheduled:
+            self._add(i, -self.weights[i])
+            self.scheduled.add(i)
+        self.cards[i]['metadata']['due'] = due
+        heapq.heappush(self.due_heap, (due, card_id))
+
+    def next_due(self, now, exclude=()):
+        """最早到期 (due <= now) 且不在 exclude 內的卡；過時的 heap 項目會順手移除"""
+        exclude = set(exclude)
+        skipped, found = [], None
+        while self.due_heap and self.due_heap[0][0] <= now:
+            due, cid = self.due_heap[0]
+            card = self.get(cid)
+            if card is None or card['metadata'].get('due') != due:
+                heapq.heappop(self.due_heap)
+                continue
+            if cid in exclude:
+                skipped.append(heapq.heappop(self.due_heap))
+                continue
+            found = card
+            break
+        for entry in skipped:
+            heapq.heappush(self.due_heap, entry)
+        return found
+
+    def draw(self, exclude=()):
+        """按權重抽一張未排程 (新) 的卡；exclude 內的卡會被暫時歸零；沒有可抽的卡時回傳 None"""
+        excluded = set(exclude)
+        held = [(i, self.weights[i]) for i in (self.pos.get(cid) for cid in excluded) if i is not None and i not in self.scheduled]
+        for i, w in held:
+            self._add(i, -w)
+        try:
+            total = self._prefix(len(self.weights))
+            if total > 1e-9:
+                i = self._find(random.random() * total)
+                if i not in self.scheduled and self.cards[i]['id'] not in excluded:
+                    return self.cards[i]
+            # 權重全是 0 (或只剩浮點誤差)：在未排程的卡中平均抽
+            candidates = [i for cid, i in self.pos.items() if i not in self.scheduled and cid not in excluded]
+            return self.cards[random.choice(candidates)] if candidates else None
+        finally:
+            for i, w in held:
+                self._add(i, w)
+
+def draw_next_card():
+    """
+    抽下一張卡 (盡量排除最近 NO_REPEAT_WINDOW 張)：先取已到期的卡，其次按權重抽未排程的新卡；
+    兩者都只剩最近抽過的卡時寧可重複，全部卡都未到期時才取最快到期的一張，
+    剛評為「記得了」的卡不會因題庫細小而馬上重複出現
+    """
+    sampler = st.session_state['card_pool']
+    recent = st.session_state.setdefault('recent_card_ids', [])
+    window = min(NO_REPEAT_WINDOW, len(sampler) - 1)
+    exclude = recent[-window:] if window > 0 else ()
+    now = time.time()
+    card = (sampler.next_due(now, exclude=exclude) or sampler.draw(exclude=exclude)
+            or sampler.next_due(now) or sampler.draw()
+            or sampler.next_due(float('inf'), exclude=exclude) or sampler.next_due(float('inf')))
+    recent.append(card['id'])
+    del recent[:-NO_REPEAT_WINDOW]
+    return card
+
+DUPLICATE_THRESHOLD = 0.92   # cosine 相似度達此值即視為重複題目
+SIMILAR_TOP_K = 8            # 「相似題目」搜尋的結果數量
+
+def nearest_cards(vector, subject=None, top_k=SIMILAR_TOP_K):
+    """
+    以向量查詢最相似的卡片：題庫 query 的結果加上仍在寫入佇列中的新卡，
+    排除已排隊刪除的卡；回傳 [(score, id)]，按相似度由高至低
+    """
+    res = index.query(vector=vector, top_k=top_k, include_metadata=False, filter={"subject": subject} if subject else None)
+    scores = {m['id']: float(m['score']) for m in res['matches']}
+    q = np.asarray(vector, dtype=np.float32)
+    q_norm = np.linalg.norm(q)
+    for cid, (values, md) in write_queue.pending_upserts().items():
+        if subject and md.get('subject') != subject:
+            continue
+        v = np.asarray(values, dtype=np.float32)
+        scores[cid] = float(v @ q / ((np.linalg.norm(v) * q_norm) or 1.0))
+    deleted = write_queue.pending_deletes()
+    ranked = sorted(((score, cid) for cid, score in scores.items() if cid not in deleted), reverse=True)
+    return ranked[:top_k]
+
+def manual_save_to_cloud(subject, question, answer, note_type, force=False):
+    """
+    存入題庫；同一學科已有相似度達 DUPLICATE_THRESHOLD 的卡時先不儲存，
+    記錄在 session_state['pending_duplicate'] 讓用戶選擇合併 / 仍然新增 / 略過 (force=True 略過檢查)
+    """
     global index
     if not index:
-        st.error("❌ 未連接 Pinecone")
+        st.error("❌ 未連接題庫")
         return
     question = clean_latex(question)
     answer = clean_latex(answer)
     text_to_embed = f"{subject}: {question}"
-    vector = embed_model.encode(text_to_embed).tolist()
+    with tracer.span("embed.encode", chars=len(text_to_embed)) as rec:
+        vector = embed_model.encode(text_to_embed, stats=rec).tolist()
+    if not force:
+        try:
+            with tracer.span("cards.dedupe") as rec:
+                near = nearest_cards(vector, subject, top_k=1)
+                rec["score"] = near[0][0] if near else None
+        except Exception:
+            near = []   # 查詢失敗不阻止儲存
+        if near and near[0][0] >= DUPLICATE_THRESHOLD and deck_mirror.get(near[0][1]):
+            st.session_state['pending_duplicate'] = {
+                "subject": subject, "question": question, "answer": answer, "type": note_type,
+                "match_id": near[0][1], "score": near[0][0],
+            }
+            st.toast(f"🔁 【{subject}】已有相似題目，請選擇處理方式", icon="⚠️")
+            return
     metadata = {
         "subject": subject, "question": question, "answer": answer,
         "type": note_type, "date_added": datetime.datetime.now().strftime("%Y-%m-%d"),
@@ -108,12 +1131,104 @@ def manual_save_to_cloud(subject, question, answer, note_type):
     }
     unique_id = str(uuid.uuid4())
     try:
-        index.upsert(vectors=[(unique_id, vector, metadata)])
+        write_queue.upsert(unique_id, vector, metadata)
+        deck_mirror.put(unique_id, metadata)
         st.toast(f"☁️ 已存入【{subject}】！", icon="✅")
-        if 'card_pool' in st.session_state: del st.session_state['card_pool']
+        add_to_card_pool([unique_id])
+    except Exception as e:
+        st.error(f"上傳失敗: {e}")
+
+def merge_into_card(card_id, answer):
+    """把新的答案合併到已存在的卡 (保留原卡的溫習紀錄)"""
+    current = deck_mirror.get(card_id)
+    if current is None:
+        return False
+    old = current.get('answer') or ""
+    if answer.strip() and answer.strip() not in old:
+        fields = {"answer": f"{old}\n\n---\n\n{answer}" if old else answer, "timestamp": time.time()}
+        write_queue.update(card_id, fields)
+        deck_mirror.patch(card_id, fields)
+    return True
+
+def resolve_duplicate(action):
+    """處理 pending_duplicate：merge = 合併到舊卡，add = 仍然新增，其他 = 略過"""
+    dup = st.session_state.pop('pending_duplicate', None)
+    if not dup:
+        return
+    try:
+        if action == "add":
+            manual_save_to_cloud(dup['subject'], dup['question'], dup['answer'], dup['type'], force=True)
+        elif action == "merge":
+            if merge_into_card(dup['match_id'], dup['answer']):
+                st.toast("🔀 已合併到原有題目", icon="✅")
+            else:
+                manual_save_to_cloud(dup['subject'], dup['question'], dup['answer'], dup['type'], force=True)
+        else:
+            st.toast("⏭️ 已略過，未加入題庫", icon="ℹ️")
     except Exception as e:
         st.error(f"上傳失敗: {e}")
 
+def search_similar_cards(subject):
+    """「相似題目」搜尋：以輸入文字 (留空則用目前的卡) 做 embedding 查詢，結果存於 session_state['similar_results']"""
+    query = st.session_state.get('sim_query', '').strip()
+    current = st.session_state.get('current_card_data')
+    if query:
+        text = f"{subject}: {query}" if subject else query
+    elif current:
+        text = f"{current['metadata'].get('subject')}: {current['metadata'].get('question', '')}"
+    else:
+        st.toast("請先輸入題目或關鍵字", icon="🔍")
+        return
+    try:
+        with tracer.span("embed.encode", chars=len(text)) as rec:
+            vector = embed_model.encode(text, stats=rec).tolist()
+        with tracer.span("cards.similar", top_k=SIMILAR_TOP_K) as rec:
+            ranked = nearest_cards(vector, subject, top_k=SIMILAR_TOP_K + 1)
+            rec["matches"] = len(ranked)
+    except Exception as e:
+        st.error(f"搜尋失敗: {e}")
+        return
+    if not query:
+        ranked = [(score, cid) for score, cid in ranked if cid != current['id']]
+    st.session_state['similar_results'] = ranked[:SIMILAR_TOP_K]
+
+def pick_card(card_id):
+    """把搜尋結果中的卡設為目前的卡"""
+    pool = st.session_state.get('card_pool')
+    card = pool.get(card_id) if pool is not None else None
+    if card is None and deck_mirror.get(card_id):
+        card = {"id": card_id, "metadata": deck_mirror.get(card_id)}
+    if card:
+        st.session_state['current_card_data'] = card
+
+SRS_DEFAULT_EASE = 2.5
+SRS_MIN_EASE = 1.3
+SRS_HARD_FACTOR = 1.2                # 「不確定」時 interval 只小幅增長
+SRS_RELEARN_DELAY = 10 * 60          # 秒：答錯的卡 10 分鐘後再出現
+RATING_QUALITY = {1: 1, 2: 3, 3: 5}  # 三個按鈕對應 SM-2 的評分 (0-5)
+
+def schedule_review(metadata, rating, now=None):
+    """SM-2：按評分計算新的 ease、reps、interval (日) 及 due (epoch 秒)"""
+    now = time.time() if now is None else now
+    q = RATING_QUALITY[rating]
+    ease = float(metadata.get('ease', SRS_DEFAULT_EASE))
+    ease = max(SRS_MIN_EASE, ease + 0.1 - (5 - q) * (0.08 + (5 - q) * 0.02))
+    reps = int(metadata.get('reps', 0))
+    interval = float(metadata.get('interval', 0.0))
+    if q < 3:
+        reps, interval = 0, 0.0
+        due = now + SRS_RELEARN_DELAY
+    else:
+        reps += 1
+        growth = ease if q == 5 else SRS_HARD_FACTOR
+        interval = 1.0 if reps == 1 else 6.0 if reps == 2 else round(max(interval, 1.0) * growth, 1)
+        due = now + interval * 86400
+    return {"ease": round(ease, 3), "reps": reps, "interval": interval, "due": due}
+
+def end_of_today():
+    tomorrow = datetime.date.today() + datetime.timedelta(days=1)
+    return time.mktime(tomorrow.timetuple())
+
 def update_weight(item_id, rating):
     global index
     if not index: return
@@ -129,7 +1244,18 @@ def update_weight(item_id, rating):
         new_weight = 1.0
         msg = "✅ 標記：已掌握"
     try:
-        index.update(id=item_id, set_metadata={"weight": new_weight})
+        now = time.time()
+        card = st.session_state['card_pool'].get(item_id) if 'card_pool' in st.session_state else None
+        current = card['metadata'] if card else (deck_mirror.get(item_id) or {})
+        fields = {"weight": new_weight, "timestamp": now}
+        fields.update(schedule_review(current, rating, now))
+        write_queue.update(item_id, fields)
+        deck_mirror.patch(item_id, fields)
+        if 'card_pool' in st.session_state:
+            st.session_state['card_pool'].set_weight(item_id, new_weight)
+            st.session_state['card_pool'].reschedule(item_id, fields['due'])
+        if fields['interval']:
+            msg += f" ({fields['interval']:g} 日後再溫)"
         st.toast(msg, icon="⚡")
         if 'current_card_data' in st.session_state:
             del st.session_state['current_card_data']
@@ -140,20 +1266,852 @@ def delete_from_cloud(item_id):
     global index
     if not index: return
     try:
-        index.delete(ids=[item_id])
+        write_queue.delete(item_id)
+        deck_mirror.drop([item_id])
         st.toast("🗑️ 已刪除", icon="✅")
         if 'current_card_data' in st.session_state:
             del st.session_state['current_card_data']
         if 'card_pool' in st.session_state:
-            del st.session_state['card_pool']
+            st.session_state['card_pool'].remove(item_id)
     except Exception as e:
         st.error(f"刪除失敗: {e}")
 
+def refresh_card_pool():
+    """由本地鏡像重建抽卡池 (不經網絡)"""
+    f_sub = st.session_state.get('last_filter', "顯示全部")
+    st.session_state['card_pool'] = WeightedCardSampler(deck_mirror.cards(None if f_sub == "顯示全部" else f_sub))
+
+def add_to_card_pool(card_ids):
+    """把剛寫入鏡像的卡加入目前的抽卡池 (只加入符合學科篩選的卡；未建立抽卡池時略過)"""
+    sampler = st.session_state.get('card_pool')
+    if sampler is None:
+        return
+    f_sub = st.session_state.get('last_filter', "顯示全部")
+    for cid in card_ids:
+        md = deck_mirror.get(cid)
+        if md is not None and f_sub in ("顯示全部", md.get('subject')):
+            sampler.add({"id": cid, "metadata": md})
+
+def regenerate_last_answer():
+    """問答頁「🔁 重新回答」：移除最後一個回答，rerun 時略過快取重新回答同一條問題"""
+    messages = st.session_state.get('messages') or []
+    if len(messages) >= 2 and messages[-1]['role'] == 'assistant':
+        messages.pop()
+        st.session_state['chat_regen_question'] = messages[-1]['content']
+
+def resync_deck():
+    st.session_state['deck_synced'] = False
+    if 'card_pool' in st.session_state: del st.session_state['card_pool']
+    if 'current_card_data' in st.session_state: del st.session_state['current_card_data']
+
 def skip_card():
     if 'current_card_data' in st.session_state:
-        st.session_state['previous_card_id'] = st.session_state['current_card_data']['id']
         del st.session_state['current_card_data']
 
+QA_LINE_RE = re.compile(r'^\s*(?:[-*]\s*)?(?:\*\*)?\s*([QA])\s*\d*\s*[:：]\s*(?:\*\*)?\s*(.*)$', re.IGNORECASE)
+# 同一行內的「A:」(Q: ... A: ...)：只認大寫 A，前面要有空白 (或中文問號等標點)，
+# 避免把題目中的 a:b、DNA: 之類當成答案
+QA_INLINE_A_RE = re.compile(r'(?<=[\s？。！）])(?:\*\*)?A\s*\d*\s*[:：]\s*(?:\*\*)?\s*')
+IMPORT_EMBED_BATCH = 64     # SentenceTransformer.encode 的 batch_size
+IMPORT_UPSERT_CHUNK = 200   # 每次 upsert 的卡片數量 (亦是續傳的單位)
+
+def iter_qa_pairs(lines):
+    """
+    逐行解析「Q: ... A: ...」格式，產生 (question, answer)
+    Q 與 A 可在同一行 (以該行最後一個「A:」分開，但下一行是獨立的 A: 行時不分開)；
+    多行內容會接到上一個欄位；標題 (#) 或分隔線 (---) 會結束當前題目
+    """
+    q_lines, a_lines, field = None, None, None
+    inline = None   # 上一行 Q 的同行分拆 (問題, 答案)，待看到下一行才決定是否採用
+    for line in lines:
+        line = line.rstrip('\n')
+        m = QA_LINE_RE.match(line)
+        if inline and not (m and m.group(1).upper() == 'A'):
+            q_lines, a_lines, field = [inline[0]], [inline[1]], 'a'
+        inline = None
+        if m and m.group(1).upper() == 'Q':
+            if q_lines and a_lines:
+                yield "\n".join(q_lines).strip(), "\n".join(a_lines).strip()
+            q_lines, a_lines, field = [m.group(2)], None, 'q'
+            splits = list(QA_INLINE_A_RE.finditer(m.group(2)))
+            if splits:
+                inline = (m.group(2)[:splits[-1].start()], m.group(2)[splits[-1].end():])
+        elif m and q_lines is not None and a_lines is None:
+            a_lines, field = [m.group(2)], 'a'
+        elif line.lstrip().startswith('#') or line.strip() == '---':
+            if q_lines and a_lines:
+                yield "\n".join(q_lines).strip(), "\n".join(a_lines).strip()
+            q_lines, a_lines, field = None, None, None
+        elif field == 'q':
+            q_lines.append(line)
+        elif field == 'a':
+            a_lines.append(line)
+    if inline:
+        q_lines, a_lines = [inline[0]], [inline[1]]
+    if q_lines and a_lines:
+        yield "\n".join(q_lines).strip(), "\n".join(a_lines).strip()
+
+def import_qa_cards(subject, pairs, note_type="匯入", progress=None):
+    """
+    批次匯入題目：每 IMPORT_UPSERT_CHUNK 題做一次 encode + upsert。
+    卡片 ID 由學科 + 題目決定，重複匯入不會產生重複卡片：
+    已存在的卡只在答案不同時更新答案，權重及溫習紀錄 (SM-2) 保持不變；
+    已完成的分塊記錄在 session_state (按後端、學生及內容區分)，失敗後再按一次會從中斷處繼續，完成後清除。
+    回傳 (已完成題數, 總題數, 錯誤訊息或 None)
+    """
+    pairs = [(clean_latex(q), clean_latex(a)) for q, a in pairs if q.strip() and a.strip()]
+    job_key = hashlib.sha256(json.dumps([backend_key, namespace, subject, pairs], ensure_ascii=False).encode()).hexdigest()
+    jobs = st.session_state.setdefault('import_jobs', {})
+    done = jobs.get(job_key, 0)
+    total = len(pairs)
+    if progress and total: progress.progress(done / total, text=f"已匯入 {done}/{total}")
+    while done < total:
+        chunk = [(str(uuid.uuid5(uuid.NAMESPACE_URL, f"{subject}:{q}")), q, a) for q, a in pairs[done:done + IMPORT_UPSERT_CHUNK]]
+        try:
+            # 已存在的卡：先看本地鏡像，鏡像未有的再向題庫 fetch
+            existing = {cid: deck_mirror.get(cid) for cid, _, _ in chunk}
+            missing = [cid for cid, md in existing.items() if md is None]
+            for i in range(0, len(missing), FETCH_BATCH_SIZE):
+                fetched = index.fetch(ids=missing[i:i + FETCH_BATCH_SIZE]).vectors
+                existing.update({cid: dict(vec.metadata or {}) for cid, vec in fetched.items()})
+            new = [(cid, q, a) for cid, q, a in chunk if existing.get(cid) is None]
+            items = []
+            if new:
+                texts = [f"{subject}: {q}" for _, q, _ in new]
+                with tracer.span("embed.encode", chars=sum(map(len, texts))) as rec:
+                    vectors = embed_model.encode(texts, batch_size=IMPORT_EMBED_BATCH, stats=rec)
+                today = datetime.datetime.now().strftime("%Y-%m-%d")
+                for (cid, q, a), vec in zip(new, vectors):
+                    metadata = {
+                        "subject": subject, "question": q, "answer": a,
+                        "type": note_type, "date_added": today,
+                        "weight": 20.0, "timestamp": time.time()
+                    }
+                    items.append((cid, vec.tolist(), metadata))
+                index.upsert(vectors=items)
+        except Exception as e:
+            return done, total, str(e)
+        mirror_items = [(cid, metadata) for cid, _, metadata in items]
+        for cid, _, a in chunk:
+            md = existing.get(cid)
+            if md is not None and md.get('answer') != a:
+                fields = {"answer": a, "timestamp": time.time()}
+                write_queue.update(cid, fields)
+                mirror_items.append((cid, {**md, **fields}))
+        deck_mirror.put_many(mirror_items)
+        add_to_card_pool(cid for cid, _ in mirror_items)
+        done += len(chunk)
+        jobs[job_key] = done
+        if progress: progress.progress(done / total, text=f"已匯入 {done}/{total}")
+    jobs.pop(job_key, None)
+    return done, total, None
+
+DECK_FORMAT = "dse-deck"
+DECK_FORMAT_VERSION = 1
+DECK_MANIFEST_FILE = "manifest.json"
+DECK_CARDS_FILE = "cards.jsonl"          # 每行 {"id", "metadata"}，次序與向量列相同
+DECK_VECTORS_FILE = "vectors.f16.npy"    # float16 (n, dim)，可用 np.load(mmap_mode='r') 開啟
+TRANSFER_BATCH = 256                      # 匯入 / 遷移時每批編碼及寫入的卡片數量 (亦是 checkpoint 的單位)
+MIGRATION_DIR = os.path.join(APP_DIR, ".migrations")
+
+def card_embed_text(metadata):
+    """卡片用於 embedding 的文字 (與存入題庫時相同)"""
+    return f"{metadata.get('subject', 'Unknown')}: {metadata.get('question', '')}"
+
+def local_store_root(model_name):
+    """本地題庫按 embedding 模型分開存放 (預設模型沿用原來的位置)"""
+    if model_name == DEFAULT_EMBED_MODEL:
+        return LOCAL_STORE_DIR
+    return os.path.join(LOCAL_STORE_DIR, "models", re.sub(r'[^A-Za-z0-9_.-]+', '_', model_name))
+
+def export_deck(idx, model_name, progress=None):
+    """
+    匯出題庫為 zip：manifest.json + cards.jsonl + vectors.f16.npy (不壓縮)；
+    向量由 index fetch 取得，每批直接寫入預先分配的 float16 陣列，體積約為 float32 JSON 的十分之一
+    """
+    ids = sorted(list_all_ids(idx))
+    rows = []
+    vectors = None   # 第一批取得後才知道維度
+    for i in range(0, len(ids), FETCH_BATCH_SIZE):
+        batch = ids[i:i + FETCH_BATCH_SIZE]
+        found = idx.fetch(ids=batch).vectors
+        for cid in batch:
+            if cid in found:
+                values = found[cid].values
+                if vectors is None:
+                    vectors = np.empty((len(ids), len(values)), dtype=np.float16)
+                vectors[len(rows)] = values
+                rows.append({"id": cid, "metadata": dict(found[cid].metadata or {})})
+        if progress: progress.progress(min(i + FETCH_BATCH_SIZE, len(ids)) / len(ids), text=f"📤 已讀取 {len(rows)}/{len(ids)}")
+    # 空題庫 (或全部在讀取期間被刪除) 仍匯出有效的檔案
+    vectors = vectors[:len(rows)] if vectors is not None else np.empty((0, 0), dtype=np.float16)
+    manifest = {"format": DECK_FORMAT, "version": DECK_FORMAT_VERSION, "model": model_name,
+                "dim": int(vectors.shape[1]) if rows else None, "count": len(rows),
+                "created": datetime.datetime.now().isoformat(timespec='seconds')}
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, 'w') as zf:
+        zf.writestr(DECK_MANIFEST_FILE, json.dumps(manifest, ensure_ascii=False, indent=2), compress_type=zipfile.ZIP_DEFLATED)
+        zf.writestr(DECK_CARDS_FILE, "".join(json.dumps(r, ensure_ascii=False) + "\n" for r in rows), compress_type=zipfile.ZIP_DEFLATED)
+        with zf.open(DECK_VECTORS_FILE, 'w') as fp:   # ZipFile 預設 ZIP_STORED (不壓縮)
+            np.save(fp, vectors)
+    return buf.getvalue()
+
+def read_deck_bundle(src):
+    """
+    讀取匯出檔：src 為 zip (路徑或檔案物件) 或已解壓的資料夾 (向量以 memmap 開啟)；
+    回傳 (manifest, cards, vectors)
+    """
+    if isinstance(src, str) and os.path.isdir(src):
+        with open(os.path.join(src, DECK_MANIFEST_FILE), encoding='utf-8') as fp:
+            manifest = json.load(fp)
+        with open(os.path.join(src, DECK_CARDS_FILE), encoding='utf-8') as fp:
+            cards = [json.loads(line) for line in fp if line.strip()]
+        vectors = np.load(os.path.join(src, DECK_VECTORS_FILE), mmap_mode='r')
+    else:
+        with zipfile.ZipFile(src) as zf:
+            manifest = json.loads(zf.read(DECK_MANIFEST_FILE))
+            cards = [json.loads(line) for line in zf.read(DECK_CARDS_FILE).decode('utf-8').splitlines() if line.strip()]
+            vectors = np.load(io.BytesIO(zf.read(DECK_VECTORS_FILE)))
+    if manifest.get("format") != DECK_FORMAT or manifest.get("version", 0) > DECK_FORMAT_VERSION:
+        raise ValueError("不是本程式匯出的題庫檔，或版本較新")
+    if len(cards) != len(vectors):
+        raise ValueError(f"題庫檔不完整：{len(cards)} 張卡，{len(vectors)} 個向量")
+    return manifest, cards, vectors
+
+class DeckTransferJob:
+    """
+    分批把卡片寫入 target index：ids 為卡片 ID (或回傳 ID 的函數，只在沒有 checkpoint 時呼叫)，
+    load_batch(ids) 回傳 [(id, metadata, vector 或 None)]，
+    有 embedder 時整批重新編碼 (換模型 / 維度)。ID 次序在第一批完成時寫入一次 ({job_id}.ids.json)，
+    之後每批只把進度寫入 checkpoint 檔；中斷後以相同 job_id 再執行會從下一批繼續；完成後刪除兩個檔案
+    """
+    def __init__(self, job_id, ids, load_batch, target, embedder=None, batch_size=TRANSFER_BATCH):
+        self.path = os.path.join(MIGRATION_DIR, f"{job_id}.json")
+        self.ids_path = os.path.join(MIGRATION_DIR, f"{job_id}.ids.json")
+        self.load_batch = load_batch
+        self.target = target
+        self.embedder = embedder
+        self.batch_size = batch_size
+        self.state = self.ids = None
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, encoding='utf-8') as fp:
+                    self.state = json.load(fp)
+                with open(self.ids_path, encoding='utf-8') as fp:
+                    self.ids = json.load(fp)
+            except (OSError, ValueError):
+                self.state = self.ids = None
+        self.ids_saved = self.ids is not None
+        if self.ids is None:
+            # 第一次執行時固定 ID 次序，續傳才能按同一次序跳過已完成的批次
+            self.ids = sorted(ids() if callable(ids) else ids)
+            self.state = {"done": 0}
+
+    @property
+    def done(self):
+        return self.state["done"]
+
+    @property
+    def total(self):
+        return len(self.ids)
+
+    @staticmethod
+    def _write_json(path, data):
+        tmp = path + ".tmp"
+        with open(tmp, 'w', encoding='utf-8') as fp:
+            json.dump(data, fp)
+        os.replace(tmp, path)
+
+    def _save(self):
+        os.makedirs(MIGRATION_DIR, exist_ok=True)
+        if not self.ids_saved:
+            # checkpoint 必須在 ID 檔之後出現，否則續傳時會找不到 ID 次序
+            self._write_json(self.ids_path, self.ids)
+            self.ids_saved = True
+        self._write_json(self.path, self.state)
+
+    def run(self, progress=None, on_batch=None):
+        """執行至完成；on_batch(items) 在每批寫入後呼叫 (items 為 [(id, values, metadata)])"""
+        ids = self.ids
+        target_dim = None
+        if self.done < self.total:
+            target_dim = getattr(self.target.describe_index_stats(), 'dimension', None)
+        while self.done < self.total:
+            # 續傳時整批卡可能已被刪除 (load_batch 回傳 [])：不用編碼，直接記錄進度
+            batch = self.load_batch(ids[self.done:self.done + self.batch_size])
+            if self.embedder is not None and batch:
+                vectors = self.embedder.encode([card_embed_text(md) for _, md, _ in batch], batch_size=IMPORT_EMBED_BATCH)
+            else:
+                vectors = [vec for _, _, vec in batch]
+            items = [(cid, np.asarray(vec, dtype=np.float32).tolist(), md) for (cid, md, _), vec in zip(batch, vectors)]
+            if items and target_dim and len(items[0][1]) != target_dim:
+                raise ValueError(f"向量維度 {len(items[0][1])} 與目標題庫的 {target_dim} 不符")
+            if items:
+                # 以寫入時間為 timestamp，其他裝置的 DeckMirror.sync 才會拉取這些卡
+                now = time.time()
+                items = [(cid, values, {**md, "timestamp": now}) for cid, values, md in items]
+                self.target.upsert(vectors=items)
+                if on_batch: on_batch(items)
+            self.state["done"] = min(self.done + self.batch_size, self.total)
+            self._save()
+            if progress: progress.progress(self.done / self.total, text=f"已處理 {self.done}/{self.total}")
+        for path in (self.path, self.ids_path):
+            if os.path.exists(path):
+                os.remove(path)
+        return self.done, self.total
+
+def restore_deck(data, progress=None):
+    """
+    還原匯出檔到目前的題庫：模型及維度相同時直接寫入檔內的向量，
+    否則以目前的模型重新編碼；可續傳 (job_id 由後端、namespace、模型及檔案內容的 hash 組成)
+    """
+    manifest, cards, vectors = read_deck_bundle(io.BytesIO(data))
+    index_dim = index.describe_index_stats().dimension
+    reembed = manifest.get("model") != EMBED_MODEL_NAME or (index_dim and manifest.get("dim") and index_dim != manifest["dim"])
+    rows = {c["id"]: (c.get("metadata") or {}, i) for i, c in enumerate(cards)}
+
+    def load_batch(ids):
+        return [(cid, rows[cid][0], None if reembed else vectors[rows[cid][1]]) for cid in ids]
+
+    def on_batch(items):
+        deck_mirror.put_many((cid, md) for cid, _, md in items)
+        add_to_card_pool(cid for cid, _, _ in items)
+
+    # 與 migrate_deck 相同：job_id 包含後端、namespace 及模型，不同題庫還原同一檔案時不會共用進度
+    job_id = "restore-" + hashlib.sha256(json.dumps([backend_key, namespace, EMBED_MODEL_NAME, hashlib.sha256(data).hexdigest()]).encode()).hexdigest()[:16]
+    job = DeckTransferJob(job_id, list(rows), load_batch, index, embed_model if reembed else None)
+    with tracer.span("deck.restore", cards=len(rows), reembed=bool(reembed)):
+        done, total = job.run(progress, on_batch)
+    return done, total, bool(reembed)
+
+def migrate_deck(target, target_model, job_id, progress=None):
+    """把目前題庫 (namespace) 的所有卡以 target_model 重新編碼後寫入 target；可續傳"""
+    def load_batch(ids):
+        found = {}
+        for i in range(0, len(ids), FETCH_BATCH_SIZE):
+            found.update(index.fetch(ids=ids[i:i + FETCH_BATCH_SIZE]).vectors)
+        return [(cid, dict(found[cid].metadata or {}), None) for cid in ids if cid in found]
+
+    job = DeckTransferJob(job_id, lambda: list_all_ids(index), load_batch, target, init_embedding_model(target_model))
+    with tracer.span("deck.migrate", cards=job.total, model=target_model):
+        return job.run(progress)
+
+NOTE_CHUNK_CHARS = 800        # 每段筆記的最大字數
+CHAT_CONTEXT_TOKENS = 4000    # 問答 prompt 中筆記的 token 預算
+QUIZ_CONTEXT_TOKENS = 3000    # 模擬卷 prompt 中筆記的 token 預算
+CJK_RE = re.compile(r'[\u3000-\u303f\u3400-\u9fff\uf900-\ufaff\uff00-\uffef]')
+HEADING_RE = re.compile(r'^(#{1,6})\s+(.*)$')
+
+def estimate_tokens(text):
+    """粗略估算 token 數：中文約每字 1 token，其他約每 4 字元 1 token"""
+    cjk = len(CJK_RE.findall(text))
+    return cjk + (len(text) - cjk) // 4
+
+def split_note_chunks(notes, max_chars=NOTE_CHUNK_CHARS):
+    """
+    按標題 (#) 及【檔案：】分隔切段，每段前加上所屬標題路徑；
+    過長的段落再按空行 (必要時按字數) 切開
+    """
+    chunks, headings, buf = [], [], []
+
+    def flush():
+        body = "\n".join(buf).strip()
+        buf.clear()
+        if not body:
+            return
+        prefix = " > ".join(title for _, title in headings)
+        piece = ""
+        for para in re.split(r'\n\s*\n', body):
+            while len(para) > max_chars:
+                if piece:
+                    chunks.append(piece)
+                    piece = ""
+                # 盡量在換行 / 句號 / 空格處切開
+                cut = max(para.rfind(sep, max_chars // 2, max_chars) for sep in ("\n", "。", ". ", " "))
+                cut = cut + 1 if cut > 0 else max_chars
+                chunks.append(para[:cut].strip())
+                para = para[cut:].strip()
+            if piece and len(piece) + len(para) + 2 > max_chars:
+                chunks.append(piece)
+                piece = ""
+            piece = f"{piece}\n\n{para}" if piece else para
+        if piece:
+            chunks.append(piece)
+        if prefix:
+            for i in range(start, len(chunks)):
+                chunks[i] = f"[{prefix}]\n{chunks[i]}"
+
+    start = 0
+    for line in notes.splitlines():
+        m = HEADING_RE.match(line)
+        if m or line.startswith('【檔案：'):
+            flush()
+            start = len(chunks)
+            if m:
+                level = len(m.group(1))
+                while headings and headings[-1][0] >= level:
+                    headings.pop()
+                headings.append((level, m.group(2).strip()))
+            else:
+                headings = [(0, line.strip())]
+        elif line.strip() != '---':
+            buf.append(line)
+    flush()
+    return chunks
+
+class NotesIndex:
+    """筆記分段索引：段落以 embed_model 編碼 (首次查詢時)，按問題挑選最相關的段落"""
+    def __init__(self, notes):
+        self.chunks = split_note_chunks(notes)
+        self.tokens = [estimate_tokens(c) for c in self.chunks]
+        self.vectors = None
+
+    def _scores(self, query):
+        if self.vectors is None:
+            vecs = np.asarray(embed_model.encode(self.chunks, batch_size=IMPORT_EMBED_BATCH), dtype=np.float32)
+            norms = np.linalg.norm(vecs, axis=1, keepdims=True)
+            self.vectors = vecs / np.where(norms > 0, norms, 1.0)
+        q = np.asarray(embed_model.encode(query), dtype=np.float32)
+        return self.vectors @ (q / (np.linalg.norm(q) or 1.0))
+
+    def select(self, query, budget_tokens):
+        """挑選不超過 budget_tokens 的段落 (按原文順序)；沒有 query 時按固定間距抽段以覆蓋整份筆記"""
+        if query and query.strip():
+            order = np.argsort(-self._scores(query)).tolist()
+        else:
+            stride = max(1, sum(self.tokens) // max(budget_tokens, 1))
+            order = [i for offset in range(stride) for i in range(offset, len(self.chunks), stride)]
+        picked, used = [], 0
+        for i in order:
+            if used + self.tokens[i] <= budget_tokens:
+                picked.append(i)
+                used += self.tokens[i]
+        return "\n\n".join(self.chunks[i] for i in sorted(picked))
+
+def select_notes_context(notes, query, budget_tokens):
+    """筆記在預算內就整份送出，否則從 NotesIndex 挑選相關段落"""
+    if estimate_tokens(notes) <= budget_tokens:
+        return notes
+    notes_index = init_notes_index(hashlib.sha256(notes.encode('utf-8')).hexdigest(), notes)
+    with tracer.span("notes.select", chunks=len(notes_index.chunks), budget_tokens=budget_tokens,
+                     cache="hit" if notes_index.vectors is not None or not (query and query.strip()) else "miss"):
+        return notes_index.select(query, budget_tokens)
+
+LLM_MODEL = "deepseek-chat"
+LLM_MAX_CONCURRENCY = 8   # 全個程序同時進行的 DeepSeek 請求上限 (所有學生共用)
+QUIZ_SPLIT = "<<<SPLIT>>>"
+STREAM_RENDER_INTERVAL = 0.05   # 秒：串流時最短的重繪間隔，避免每個 token 都重繪
+LLM_CACHE_PATH = os.path.join(APP_DIR, ".llm_cache", "responses.sqlite")
+LLM_CACHE_TTL = 7 * 24 * 3600          # 秒：快取回覆的有效期
+LLM_CACHE_MAX_BYTES = 50 * 1024 * 1024 # 快取總大小上限，超出時淘汰最久未用的回覆
+
+class LLMResponseCache:
+    """
+    AI 回覆快取 (SQLite)：以 model + messages + 參數的 hash 為 key，
+    過期 (TTL) 即失效，總大小超出上限時按最久未使用 (LRU) 淘汰
+    """
+    def __init__(self, path, ttl=LLM_CACHE_TTL, max_bytes=LLM_CACHE_MAX_BYTES):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, value TEXT NOT NULL, created REAL NOT NULL, accessed REAL NOT NULL, size INTEGER NOT NULL)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+        self.db.commit()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(model, messages, params=None):
+        payload = json.dumps({"model": model, "messages": messages, "params": params or {}}, ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        now = time.time()
+        with self.lock:
+            row = self.db.execute("SELECT value, created FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None or now - row[1] > self.ttl:
+                if row is not None:
+                    self.db.execute("DELETE FROM responses WHERE key = ?", (key,))
+                    self.db.commit()
+                self.misses += 1
+                return None
+            self.db.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+            self.db.commit()
+            self.hits += 1
+            return row[0]
+
+    def put(self, key, value):
+        now = time.time()
+        size = len(value.encode('utf-8'))
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO responses (key, value, created, accessed, size) VALUES (?, ?, ?, ?, ?)",
+                            (key, value, now, now, size))
+            self.db.execute("DELETE FROM responses WHERE created < ?", (now - self.ttl,))
+            total = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+            if total > self.max_bytes:
+                excess = total - self.max_bytes
+                for old_key, old_size in self.db.execute("SELECT key, size FROM responses ORDER BY accessed").fetchall():
+                    if excess <= 0:
+                        break
+                    self.db.execute("DELETE FROM responses WHERE key = ?", (old_key,))
+                    excess -= old_size
+            self.db.commit()
+
+    def stats(self):
+        with self.lock:
+            count, total = self.db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+        return {"hits": self.hits, "misses": self.misses, "entries": count, "bytes": total}
+
+def stream_chat(messages, bypass_cache=False):
+    """
+    以 stream=True 呼叫 DeepSeek，逐段 yield 文字。
+    側邊欄開啟快取時先查 llm_cache；bypass_cache=True 會略過讀取但仍寫入新結果
+    """
+    use_cache = st.session_state.get('llm_cache_on', False)
+    key = LLMResponseCache.key(LLM_MODEL, messages) if use_cache else None
+    prompt_chars = sum(len(m['content']) for m in messages)
+    if use_cache and not bypass_cache:
+        with tracer.span("llm.cache", prompt_chars=prompt_chars) as rec:
+            cached = llm_cache.get(key)
+            rec["cache"] = "miss" if cached is None else "hit"
+        if cached is not None:
+            yield cached
+            return
+    parts = []
+    with tracer.span("llm.stream", prompt_chars=prompt_chars) as rec:
+        with llm_slots:
+            rec["wait_ms"] = tracer.elapsed_ms(rec)
+            stream = client.chat.completions.create(model=LLM_MODEL, messages=messages, stream=True,
+                                                    stream_options={"include_usage": True})
+            for chunk in stream:
+                if chunk.usage:
+                    rec["prompt_tokens"] = chunk.usage.prompt_tokens
+                    rec["completion_tokens"] = chunk.usage.completion_tokens
+                if chunk.choices and chunk.choices[0].delta.content:
+                    if not parts:
+                        rec["first_token_ms"] = tracer.elapsed_ms(rec)
+                    parts.append(chunk.choices[0].delta.content)
+                    yield parts[-1]
+    if use_cache and parts:
+        llm_cache.put(key, "".join(parts))
+
+def stream_to_slot(pieces, slot):
+    """把串流文字逐步畫到 st.empty() 上，回傳完整文字；模型輸出不當作 HTML (與串流後的 render_rich 一致)"""
+    text, last = "", 0.0
+    for piece in pieces:
+        text += piece
+        now = time.monotonic()
+        if now - last >= STREAM_RENDER_INTERVAL:
+            slot.markdown(clean_latex(text) + "▌")
+            last = now
+    return text
+
+QUIZ_MAX_WORKERS = 4      # 平行出題時同時進行的請求數上限
+QUIZ_SHARD_RETRIES = 2    # 每個分卷請求失敗後的重試次數
+
+def build_quiz_prompt(subject, lang, count, diff, qt, topic, notes_context, part=None):
+    """模擬卷 prompt；part=(i, n) 表示平行生成中的第 i/n 題"""
+    part_note = ""
+    if part:
+        part_note = f"\n這是全卷第 {part[0]}/{part[1]} 題：題號請寫 {part[0]}，並集中於筆記中約第 {part[0]}/{part[1]} 部分的內容，避免與其他題目重複。"
+    return f"""
+    角色：香港考評局 DSE {subject} 出卷員。
+    語言：請使用 **{lang}**。
+    任務：根據筆記{f"中「{topic}」的內容" if topic else ""}，設計 **{count} 條** {diff} 程度的 {qt}。{part_note}
+    【極重要格式指令】：
+    1. **題目/答案分離**：先列出「試題卷 (Questions)」，插入 `<<<SPLIT>>>`，再列出「答案與詳解 (Marking Scheme)」。
+    2. **MC 選項格式**：必須 **垂直分行**。
+    3. **答案格式 (Highlight & Explanation)**：
+       - 必須提供 **【詳細解釋 (Explanation)】**。
+       - **正確答案的關鍵字或選項** 必須使用 HTML 黃色高亮語法包住：
+         請使用: `<span class="highlight-answer">正確答案</span>`
+    4. **數學公式**：
+       - 行內公式用單個 $ 包住 (例如 $x^2$)。
+       - 獨立公式用兩個 $$ 包住。
+    筆記內容：{notes_context}
+    """
+
+def split_quiz(text):
+    if QUIZ_SPLIT in text:
+        q_p, a_p = text.split(QUIZ_SPLIT, 1)
+        return q_p, a_p
+    return text, "AI 未能自動分離答案，請見上方。"
+
+def complete_chat(messages, use_cache=False, bypass_cache=False):
+    """非串流呼叫 DeepSeek；不讀 session_state，可在背景線程使用"""
+    key = LLMResponseCache.key(LLM_MODEL, messages) if use_cache else None
+    prompt_chars = sum(len(m['content']) for m in messages)
+    if use_cache and not bypass_cache:
+        with tracer.span("llm.cache", prompt_chars=prompt_chars) as rec:
+            cached = llm_cache.get(key)
+            rec["cache"] = "miss" if cached is None else "hit"
+        if cached is not None:
+            return cached
+    with tracer.span("llm.complete", prompt_chars=prompt_chars) as rec:
+        with llm_slots:
+            rec["wait_ms"] = tracer.elapsed_ms(rec)
+            res = client.chat.completions.create(model=LLM_MODEL, messages=messages)
+        text = res.choices[0].message.content
+        if res.usage:
+            rec["prompt_tokens"] = res.usage.prompt_tokens
+            rec["completion_tokens"] = res.usage.completion_tokens
+    if use_cache and text:
+        llm_cache.put(key, text)
+    return text
+
+def generate_quiz_parallel(prompts, bypass_cache=False, progress=None):
+    """
+    平行出題：每個 prompt 各自請求及解析 <<<SPLIT>>>，完成後按題號合併為一份試卷和一份 Marking Scheme；
+    失敗的請求個別重試 QUIZ_SHARD_RETRIES 次，仍失敗只會標記該題，不會令整份卷失敗
+    """
+    use_cache = st.session_state.get('llm_cache_on', False)
+    results, errors = [None] * len(prompts), {}
+    attempts = [0] * len(prompts)
+    with ThreadPoolExecutor(max_workers=min(QUIZ_MAX_WORKERS, len(prompts))) as pool:
+        def submit(i):
+            return pool.submit(complete_chat, [{"role": "user", "content": prompts[i]}], use_cache, bypass_cache)
+        futures = {submit(i): i for i in range(len(prompts))}
+        while futures:
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for fut in done:
+                i = futures.pop(fut)
+                try:
+                    results[i] = split_quiz(fut.result())
+                except Exception as e:
+                    attempts[i] += 1
+                    if attempts[i] <= QUIZ_SHARD_RETRIES:
+                        futures[submit(i)] = i
+                        continue
+                    errors[i] = str(e)
+                if progress:
+                    finished = sum(r is not None for r in results) + len(errors)
+                    progress.progress(finished / len(prompts), text=f"⚡ 已完成 {finished}/{len(prompts)} 條")
+    q_parts, a_parts = [], []
+    for i, res in enumerate(results):
+        if res is None:
+            q_parts.append(f"⚠️ 第 {i + 1} 題生成失敗：{errors.get(i)}")
+            continue
+        q_parts.append(res[0].strip())
+        a_parts.append(res[1].strip())
+    return {"q": "\n\n---\n\n".join(q_parts), "a": "\n\n---\n\n".join(a_parts)}
+
+def stream_quiz(messages, bypass_cache=False):
+    """
+    串流生成模擬卷：收到 <<<SPLIT>>> 前的內容即時顯示為試題，
+    之後的 Marking Scheme 繼續串流到 expander 內，回傳 {"q", "a"}
+    """
+    st.markdown("### 📝 試題")
+    q_slot = st.empty()
+    a_slot = None
+    text, last = "", 0.0
+    for piece in stream_chat(messages, bypass_cache=bypass_cache):
+        text += piece
+        if a_slot is None and QUIZ_SPLIT in text:
+            q_slot.markdown(clean_latex(text.split(QUIZ_SPLIT, 1)[0]))
+            st.info("👇 完成作答後，點擊下方查看詳解")
+            with st.expander("🔐 查看答案與詳細解釋 (Marking Scheme)"):
+                a_slot = st.empty()
+        now = time.monotonic()
+        if now - last < STREAM_RENDER_INTERVAL:
+            continue
+        last = now
+        if a_slot is None:
+            q_slot.markdown(clean_latex(text) + "▌")
+        else:
+            a_slot.markdown(clean_latex(text.split(QUIZ_SPLIT, 1)[1]) + "▌", unsafe_allow_html=True)
+    q_p, a_p = split_quiz(text)
+    return {"q": q_p, "a": a_p}
+
+OCR_LANG = "chi_tra+eng"
+OCR_DPI = 200
+OCR_MAX_WORKERS = os.cpu_count() or 2   # 同時執行的 OCR 程序數量
+OCR_TEXT_LAYER_MIN_CHARS = 50           # PDF 頁面本身有足夠文字時，直接使用而不 OCR
+OCR_CACHE_PATH = os.path.join(APP_DIR, ".ocr_cache", "pages.sqlite")
+OCR_EXTENSIONS = ('.pdf', '.jpg', '.jpeg', '.png')
+
+class TextCache:
+    """以 key 存取文字的 SQLite 快取 (OCR 每頁結果、已解碼的上傳檔案等)"""
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS texts (key TEXT PRIMARY KEY, value TEXT NOT NULL, created REAL NOT NULL)")
+        self.db.commit()
+
+    def get_many(self, keys):
+        found = {}
+        with self.lock:
+            for i in range(0, len(keys), 500):
+                part = keys[i:i + 500]
+                found.update(self.db.execute(f"SELECT key, value FROM texts WHERE key IN ({','.join('?' * len(part))})", part))
+        return found
+
+    def put(self, key, value):
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO texts (key, value, created) VALUES (?, ?, ?)", (key, value, time.time()))
+            self.db.commit()
+
+def ocr_pages(filename, data, on_page=None):
+    """
+    OCR 一個 PDF / 圖片，回傳每頁文字。
+    每頁以 (檔案 hash, 頁碼, 語言, DPI) 為 key 快取，重新上傳或重跑不會再 OCR；
+    未快取的頁一頁一個任務，交給 OCR_MAX_WORKERS 個子程序 (ocr_worker.py) 平行處理
+    (PyMuPDF 不支援多線程，不可在 server 程序內以線程平行)；每頁完成即由 future callback 寫入快取。
+    on_page(pages, done, total) 在每頁完成時於主線程呼叫，pages 為目前已完成的結果；
+    rerun 中斷時未開始的頁會被取消，進行中的頁完成後仍會寫入快取
+    """
+    # 每個 tesseract 程序只用一條線程，由 pool 負責平行
+    os.environ.setdefault("OMP_THREAD_LIMIT", "1")
+    file_hash = hashlib.sha256(data).hexdigest()
+    if filename.lower().endswith('.pdf'):
+        import pymupdf
+        with pymupdf.open(stream=data, filetype="pdf") as doc:
+            total = doc.page_count
+        worker = ocr_worker.ocr_pdf_page
+    else:
+        total, worker = 1, ocr_worker.ocr_image
+    keys = [f"{file_hash}:{i}:{OCR_LANG}:{OCR_DPI}" for i in range(total)]
+    cached = ocr_cache.get_many(keys)
+    pages = [cached.get(k) for k in keys]
+    done = sum(p is not None for p in pages)
+    if on_page and done:
+        on_page(pages, done, total)
+    todo = [i for i, p in enumerate(pages) if p is None]
+    if todo:
+        cache = ocr_cache
+
+        def store(fut, key):
+            # 在 executor 的管理線程執行：script 已被 rerun 中斷時結果仍會寫入快取
+            if not fut.cancelled() and fut.exception() is None:
+                cache.put(key, fut.result())
+
+        # spawn：不 fork 有大量線程的 server 程序；檔案內容經 initializer 每個程序只傳一次
+        pool = ProcessPoolExecutor(max_workers=min(OCR_MAX_WORKERS, len(todo)), mp_context=multiprocessing.get_context("spawn"),
+                                   initializer=ocr_worker.init_worker, initargs=(data,))
+        try:
+            futures = {}
+            for i in todo:
+                fut = pool.submit(worker, i, OCR_LANG, OCR_DPI, OCR_TEXT_LAYER_MIN_CHARS)
+                fut.add_done_callback(lambda f, key=keys[i]: store(f, key))
+                futures[fut] = i
+            for fut in as_completed(futures):
+                i = futures[fut]
+                pages[i] = fut.result()
+                done += 1
+                if on_page:
+                    on_page(pages, done, total)
+        finally:
+            pool.shutdown(wait=False, cancel_futures=True)
+    return pages
+
+def ocr_upload(f, on_page=None):
+    """上傳的 PDF / 圖片 → 每頁文字；同一個上傳在之後的 rerun 直接取 session 內的結果，不再讀檔及 hash"""
+    memo = st.session_state.setdefault('ocr_memo', {})
+    memo_key = upload_key(f)
+    if memo_key not in memo:
+        memo[memo_key] = ocr_pages(f.name, f.getvalue(), on_page=on_page)
+    return memo[memo_key]
+
+def format_ocr_pages(pages):
+    """按頁碼順序合併已完成的頁 (未完成的頁略過)"""
+    return "\n\n".join(f"〔第 {i + 1} 頁〕\n{text.strip()}" for i, text in enumerate(pages) if text)
+
+INGEST_CACHE_PATH = os.path.join(APP_DIR, ".ingest_cache", "texts.sqlite")
+INGEST_ENCODINGS = ('utf-8-sig', 'big5hkscs', 'gb18030')   # 評分相同時的次序；big5hkscs 已包含 Big5
+INGEST_ENCODING_LABELS = {'big5hkscs': 'Big5 (HKSCS)', 'gb18030': 'GB18030'}
+INGEST_CHUNK_BYTES = 1 << 20
+INGEST_SCORE_CHARS = 1 << 16   # 評分只看開首的字元
+# 正確解碼的中文 (繁 / 簡) 常見的標點及高頻字；錯誤編碼解出的亂碼多為罕用字
+INGEST_COMMON_RE = re.compile("[，。、：；！？「」『』（）《》…的是不了在有人這这我他們们中來来個个為为上大說说到就和也要以會会時时出地得可下]")
+# 亂碼常見的私用區、擴充 B 區以後及替代字元
+INGEST_ODD_RE = re.compile("[\ue000-\uf8ff\ufffd\U00010000-\U0010ffff]")
+NON_ASCII_RE = re.compile(r"[^\x00-\x7f]")
+
+def decode_score(text):
+    """文字像正常中文的程度：常用字及中文標點佔非 ASCII 字元的比例，亂碼常見的字元倒扣"""
+    sample = text[:INGEST_SCORE_CHARS]
+    total = len(NON_ASCII_RE.findall(sample))
+    if not total:
+        return 0.0
+    return (len(INGEST_COMMON_RE.findall(sample)) - 3 * len(INGEST_ODD_RE.findall(sample))) / total
+
+def detect_and_decode(buffer):
+    """
+    偵測編碼並解碼：第一塊資料交給各候選編碼試解，UTF-8 成功即採用，
+    否則按 decode_score 排名 (Big5 與 GB18030 常常都「解得通」)；
+    之後只保留第一名繼續解碼，其他候選的輸出即時丟棄。
+    第一名在後段出錯才按排名重新試下一個。回傳 (編碼, 文字)，全部失敗回傳 (None, "")
+    """
+    view = memoryview(buffer)
+    final = len(view) <= INGEST_CHUNK_BYTES
+    candidates = []
+    for enc in INGEST_ENCODINGS:
+        decoder = codecs.getincrementaldecoder(enc)()
+        try:
+            head = decoder.decode(view[:INGEST_CHUNK_BYTES], final)
+        except UnicodeDecodeError:
+            continue
+        candidates.append((enc, decoder, head, decode_score(head)))
+    # sort 是穩定的：評分相同時維持 INGEST_ENCODINGS 的次序
+    candidates.sort(key=lambda c: (c[0] != 'utf-8-sig', -c[3]))
+    order = [c[0] for c in candidates]
+    _, decoder, head, _ = candidates[0] if candidates else (None, None, "", 0)
+    del candidates
+
+    for rank, enc in enumerate(order):
+        if rank == 0:
+            parts, start = [head], INGEST_CHUNK_BYTES
+        else:
+            decoder, parts, start = codecs.getincrementaldecoder(enc)(), [], 0
+        head = None
+        try:
+            for pos in range(start, len(view), INGEST_CHUNK_BYTES):
+                parts.append(decoder.decode(view[pos:pos + INGEST_CHUNK_BYTES], pos + INGEST_CHUNK_BYTES >= len(view)))
+        except UnicodeDecodeError:
+            continue
+        return enc, "".join(parts)
+    return None, ""
+
+def upload_key(f):
+    """上傳檔案在 session 內的識別 (重新上傳同名檔案會有新的 file_id)"""
+    return getattr(f, 'file_id', None) or f"{f.name}:{f.size}"
+
+def ingest_text_upload(f):
+    """
+    上傳的文字檔 → (編碼, 文字)。
+    同一個上傳在之後的 rerun 直接取 session 內的結果；
+    內容相同的檔案 (按 sha256) 跨 session 共用已解碼的快取
+    """
+    memo = st.session_state.setdefault('ingest_memo', {})
+    memo_key = upload_key(f)
+    if memo_key in memo:
+        return memo[memo_key]
+    buf = f.getbuffer()
+    try:
+        digest = hashlib.sha256(buf).hexdigest()
+        cached = ingest_cache.get_many([digest]).get(digest)
+        if cached is not None:
+            enc, _, text = cached.partition("\n")
+            result = (enc, text)
+        else:
+            result = detect_and_decode(buf)
+            if result[0]:
+                ingest_cache.put(digest, f"{result[0]}\n{result[1]}")
+    finally:
+        buf.release()
+    memo[memo_key] = result
+    return result
+
+def prune_ingest_memo(files):
+    """移除已不在上傳列表中的檔案結果 (文字檔及 OCR)"""
+    current = {upload_key(f) for f in files}
+    for memo in (st.session_state.get('ingest_memo', {}), st.session_state.get('ocr_memo', {})):
+        for key in list(memo):
+            if key not in current:
+                del memo[key]
+
 def copy_button_component(text_to_copy):
     js_text = json.dumps(text_to_copy)
     components.html(
@@ -177,26 +2135,109 @@ def copy_button_component(text_to_copy):
         """, height=60
     )
 
+tracer = st.session_state.setdefault('perf_tracer', PerfTracer())
+tracer.begin_rerun()
+
+def finish_rerun():
+    """記錄本次 rerun 的時間，並 (如已開啟) 在側邊欄顯示效能診斷"""
+    tracer.end_rerun()
+    if not st.session_state.get('perf_panel_on'):
+        return
+    with perf_panel.container():
+        with st.expander("🩺 效能診斷", expanded=True):
+            rows = tracer.summary()
+            if rows:
+                st.dataframe(rows, hide_index=True, use_container_width=True)
+            else:
+                st.caption("暫時未有紀錄")
+            st.caption(f"第 {tracer.rerun} 次 rerun · {len(tracer.spans)} 個 span · session {tracer.session_id}")
+            st.download_button("📤 匯出追蹤 (JSONL)", tracer.to_jsonl(), file_name=f"trace_{tracer.session_id}.jsonl",
+                               mime="application/x-ndjson", use_container_width=True)
+            st.button("🧹 清除紀錄", on_click=tracer.clear, use_container_width=True)
+
 # --- 5. 側邊欄 ---
 with st.sidebar:
     st.title("🇭🇰 DSE 備戰中心")
     st.caption("Detailed Answer Mode")
     st.divider()
     if not deepseek_key: deepseek_key = st.text_input("DeepSeek Key", type="password")
-    if not pinecone_key: pinecone_key = st.text_input("Pinecone Key", type="password")
+    storage_backend = st.radio("💾 題庫儲存", STORAGE_BACKENDS, horizontal=True)
+    if storage_backend == "☁️ Pinecone" and not pinecone_key: pinecone_key = st.text_input("Pinecone Key", type="password")
+    student_id = st.text_input("👤 學生代號", value=st.query_params.get("student", ""), help="每位學生的題庫分開儲存；留空則使用共用題庫")
+    if student_id != st.query_params.get("student", ""):
+        st.query_params["student"] = student_id
     st.divider()
     current_subject = st.selectbox("當前温習科目", ["Biology", "Chemistry", "Economics", "Chinese", "English", "History", "Maths", "Liberal Studies"])
+    st.divider()
+    st.toggle("🗃️ 快取 AI 回覆", key="llm_cache_on", help="相同問題 / 出題設定直接使用上次的回覆，不再呼叫 API")
+    st.toggle("🩺 效能診斷", key="perf_panel_on", help="顯示 embedding / 題庫 / AI 呼叫的延遲、token 用量及快取命中")
+    perf_panel = st.empty()
 
+embed_model = init_embedding_model(EMBED_MODEL_NAME)
+ocr_cache = init_ocr_cache()
+ingest_cache = init_ingest_cache()
+llm_cache = init_llm_cache()
+if st.session_state.get('llm_cache_on'):
+    cache_stats = llm_cache.stats()
+    st.sidebar.caption(f"🗃️ 快取命中 {cache_stats['hits']} / 未命中 {cache_stats['misses']} · {cache_stats['entries']} 項 ({cache_stats['bytes'] / 1024:.0f} KB)")
 client = None
 index = None
-if deepseek_key: client = OpenAI(api_key=deepseek_key, base_url="https://api.deepseek.com")
-if pinecone_key:
+llm_slots = init_llm_slots()
+namespace = student_namespace(student_id)
+if deepseek_key: client = init_llm_client(deepseek_key, deepseek_base_url)
+if storage_backend == "💻 本地":
     try:
-        pc = init_pinecone(pinecone_key)
-        index = pc.Index("dse-memory")
+        index = NamespacedIndex(init_local_store(local_store_root(EMBED_MODEL_NAME)), namespace, tracer)
+        st.sidebar.success("🟢 本地題庫已載入")
+    except Exception as e:
+        st.sidebar.error(f"本地題庫載入失敗: {e}")
+elif pinecone_key:
+    try:
+        index = NamespacedIndex(init_pinecone_index(pinecone_key, PINECONE_INDEX_NAME), namespace, tracer)
         st.sidebar.success("🟢 雲端已連線")
     except Exception as e:
         st.sidebar.error(f"連線失敗: {e}")
+deck_mirror = init_deck_mirror("local" if storage_backend == "💻 本地" else "pinecone", namespace)
+write_queue = None
+if index:
+    if storage_backend == "💻 本地":
+        backend_key = "local:" + local_store_root(EMBED_MODEL_NAME)
+    else:
+        backend_key = "pinecone:" + hashlib.sha256(pinecone_key.encode()).hexdigest()[:16] + ":" + PINECONE_INDEX_NAME
+    # 佇列按後端共用 (直接寫入未經 tracer 的 Index)，各 session 經 NamespacedQueue 帶入自己的 namespace
+    write_queue = init_write_queue(backend_key, index.idx).for_namespace(namespace)
+    n_pending = write_queue.pending()
+    if write_queue.last_error:
+        st.sidebar.warning(f"⏳ {n_pending} 項修改待寫入 (重試中：{write_queue.last_error})")
+    elif n_pending:
+        st.sidebar.caption(f"⏳ {n_pending} 項修改待寫入")
+    rejected = write_queue.rejected_items()
+    if rejected:
+        st.sidebar.error(f"❌ {len(rejected)} 項修改被題庫拒絕，已放棄寫入：{next(iter(rejected.values()))}")
+        st.sidebar.button("知道了", key="clear_rejected", on_click=write_queue.clear_rejected)
+
+# 切換後端或學生時，抽卡池與同步狀態都要重新建立
+if st.session_state.get('last_backend') != (storage_backend, namespace):
+    resync_deck()
+    st.session_state['last_backend'] = (storage_backend, namespace)
+
+# 存入題庫時發現相似題目：讓用戶選擇合併 / 仍然新增 / 略過
+if 'pending_duplicate' in st.session_state:
+    dup = st.session_state['pending_duplicate']
+    existing = deck_mirror.get(dup['match_id']) or {}
+    with st.container(border=True):
+        st.warning(f"🔁 【{dup['subject']}】題庫中已有相似題目 (相似度 {dup['score']:.0%})，要如何處理？")
+        c_new, c_old = st.columns(2)
+        with c_new:
+            st.caption("新題目")
+            st.markdown(dup['question'][:500])
+        with c_old:
+            st.caption("題庫中的題目")
+            st.markdown((existing.get('question') or "")[:500])
+        b_merge, b_add, b_skip = st.columns(3)
+        with b_merge: st.button("🔀 合併答案到原題", on_click=resolve_duplicate, args=("merge",), use_container_width=True, type="primary")
+        with b_add: st.button("➕ 仍然新增", on_click=resolve_duplicate, args=("add",), use_container_width=True)
+        with b_skip: st.button("⏭️ 略過", on_click=resolve_duplicate, args=("skip",), use_container_width=True)
 
 # --- 6. 主功能區 ---
 tab_factory, tab_study, tab_review = st.tabs(["🏭 資料清洗", "🎓 智能溫習", "🧠 抽卡溫習"])
@@ -246,7 +2287,8 @@ with tab_study:
         if method == "📋 貼上文字":
             notes = st.text_area("貼上筆記：", height=300)
         else:
-            files = st.file_uploader("上傳筆記 (.txt) 或音檔", accept_multiple_files=True)
+            files = st.file_uploader("上傳筆記 (.txt / .pdf / 圖片) 或音檔", accept_multiple_files=True)
+            note_parts = []
             if files:
                 for f in files:
                     fname = f.name.lower()
@@ -256,31 +2298,52 @@ with tab_study:
                         audio = f
                         st.caption(f"🎵 已識別音檔：{f.name}")
                     
-                    # 2. 處理 PDF/DOCX/圖片 (提示用戶去 Tab 1)
-                    elif fname.endswith(('.pdf', '.docx', '.doc', '.ppt', '.pptx', '.jpg', '.png', '.jpeg')):
+                    # 2. PDF / 圖片：本地 OCR (逐頁平行，結果快取)
+                    elif fname.endswith(OCR_EXTENSIONS):
+                        bar = st.progress(0.0, text=f"🔍 OCR：{f.name}")
+                        with st.expander(f"📄 {f.name} (OCR 預覽)", expanded=False):
+                            preview = st.empty()
+
+                        def show_ocr_progress(pages, done, total, bar=bar, preview=preview, name=f.name):
+                            bar.progress(done / total, text=f"🔍 OCR：{name} ({done}/{total} 頁)")
+                            preview.text(format_ocr_pages(pages)[-3000:])
+
+                        try:
+                            pages = ocr_upload(f, on_page=show_ocr_progress)
+                        except ImportError:
+                            bar.empty()
+                            st.warning(f"⚠️ 未安裝 OCR 套件 (pymupdf / pytesseract)，無法讀取 {f.name}。\n"
+                                       "請先使用「🏭 資料清洗」頁面，將其內容轉換為文字後再貼上。", icon="🚧")
+                        except Exception as e:
+                            bar.empty()
+                            st.error(f"❌ OCR 失敗：{f.name} ({e})", icon="🚫")
+                        else:
+                            bar.empty()
+                            st.caption(f"🔍 已 OCR：{f.name} ({len(pages)} 頁)")
+                            note_parts.append(f"\n---\n【檔案：{f.name}】\n{format_ocr_pages(pages)}")
+
+                    # 3. 處理 DOCX/PPT (提示用戶去 Tab 1)
+                    elif fname.endswith(('.docx', '.doc', '.ppt', '.pptx')):
                         st.warning(
                             f"⚠️ 無法直接讀取 {f.name} (非純文字檔)。\n"
                             "請先使用「🏭 資料清洗」頁面，將其內容轉換為文字後再貼上。", 
                             icon="🚧"
                         )
                     
-                    # 3. 處理文字檔 (.txt, .md, .py, etc.)
+                    # 4. 處理文字檔 (.txt, .md, .py, etc.)
                     else:
-                        raw_data = f.read()
-                        content = ""
-                        # 嘗試 UTF-8
-                        try:
-                            content = raw_data.decode('utf-8')
-                        except UnicodeDecodeError:
-                            # 失敗則嘗試 Big5 (常見於香港舊電腦檔案)
-                            try:
-                                content = raw_data.decode('big5')
-                                st.caption(f"ℹ️ 已使用 Big5 編碼讀取：{f.name}")
-                            except UnicodeDecodeError:
-                                st.error(f"❌ 檔案讀取失敗：{f.name} (編碼無法識別，請轉存為 UTF-8)", icon="🚫")
-                        
+                        encoding, content = ingest_text_upload(f)
+                        if encoding is None:
+                            st.error(f"❌ 檔案讀取失敗：{f.name} (編碼無法識別，請轉存為 UTF-8)", icon="🚫")
+                        elif encoding in INGEST_ENCODING_LABELS:
+                            # 非 UTF-8 (常見於香港舊電腦檔案)
+                            st.caption(f"ℹ️ 已使用 {INGEST_ENCODING_LABELS[encoding]} 編碼讀取：{f.name}")
+
                         if content:
-                            notes += f"\n---\n【檔案：{f.name}】\n{content}"
+                            note_parts.append(f"\n---\n【檔案：{f.name}】\n{content}")
+
+                prune_ingest_memo(files)
+            notes = "".join(note_parts)
 
     with c_main:
         # 檢查是否有內容 (文字筆記 或 音檔 都可以觸發顯示)
@@ -289,9 +2352,10 @@ with tab_study:
         else:
             if not client:
                 st.error("缺 API Key")
+                finish_rerun()
                 st.stop()
             
-            s1, s2, s3 = st.tabs(["🎧 聽書 / 筆記", "💬 問答", "✍️ 模擬卷 (Answer Pro)"])
+            s1, s2, s3, s4 = st.tabs(["🎧 聽書 / 筆記", "💬 問答", "✍️ 模擬卷 (Answer Pro)", "📥 匯入題庫"])
             
             with s1:
                 if audio:
@@ -309,36 +2373,35 @@ with tab_study:
                 lang_choice = st.radio("回答語言", ["中文 (廣東話)", "English"], index=default_lang_idx, horizontal=True)
                 if "messages" not in st.session_state:
                     st.session_state.messages = []
-                for m in st.session_state.messages:
-                    content = clean_latex(m["content"])
-                    if content.startswith('$$') and content.endswith('$$'):
-                        st.chat_message(m["role"]).latex(content.replace('$$', ''))
-                    else:
-                        st.chat_message(m["role"]).markdown(content)
+                history = st.session_state.messages
+                hidden = max(len(history) - CHAT_HISTORY_VISIBLE, 0)
+                if hidden and not st.toggle(f"📜 顯示較早的 {hidden} 則訊息", key="show_full_history"):
+                    history = history[hidden:]
+                for m in history:
+                    render_rich(chat_message_segments(m), st.chat_message(m["role"]))
+                if len(st.session_state.messages) >= 2 and st.session_state.messages[-1]["role"] == "assistant":
+                    st.button("🔁 重新回答", key="chat_regen", on_click=regenerate_last_answer, help="略過快取，重新回答最後一條問題")
 
+                regen_q = st.session_state.pop('chat_regen_question', None)
                 if q := st.chat_input("輸入問題..."):
-                    st.session_state.messages.append({"role": "user", "content": q})
+                    st.session_state.messages.append({"role": "user", "content": q, "segments": render_segments(q)})
                     st.chat_message("user").write(q)
+                if q or regen_q:
+                    bypass = not q   # 只有「🔁 重新回答」略過快取
+                    q = q or regen_q
                     with st.chat_message("assistant"):
-                        context_notes = notes if notes else "（無筆記內容，請依常識回答）"
+                        context_notes = select_notes_context(notes, q, CHAT_CONTEXT_TOKENS) if notes else "（無筆記內容，請依常識回答）"
                         lang_instruction = "用廣東話回答" if lang_choice == "中文 (廣東話)" else "Answer in English"
-                        rag = f"DSE 導師。{lang_instruction}。數學公式單個 $ 包住。\n筆記：{context_notes[:12000]}"
-                        ans = client.chat.completions.create(model="deepseek-chat", messages=[{"role":"system","content":rag},{"role":"user","content":q}]).choices[0].message.content
-                        display_ans = clean_latex(ans)
-                        
-                        if '$$' in display_ans:
-                            parts = re.split(r'(\$\$.*?\$\$)', display_ans, flags=re.DOTALL)
-                            for part in parts:
-                                if part.startswith('$$'):
-                                    st.latex(part.replace('$$', ''))
-                                else:
-                                    st.markdown(part)
-                        else:
-                            st.markdown(display_ans)
-                            
+                        rag = f"DSE 導師。{lang_instruction}。數學公式單個 $ 包住。\n筆記：{context_notes}"
+                        ans_slot = st.empty()
+                        ans = stream_to_slot(stream_chat([{"role":"system","content":rag},{"role":"user","content":q}], bypass_cache=bypass), ans_slot)
+                        ans_segments = render_segments(ans)
+                        render_rich(ans_segments, ans_slot.container())
+
+                        embed_model.warm()
                         st.button("☁️ 加入題庫", key=f"s_{len(st.session_state.messages)}", on_click=manual_save_to_cloud, args=(current_subject, q, ans, "問答"))
 
-                    st.session_state.messages.append({"role": "assistant", "content": ans})
+                    st.session_state.messages.append({"role": "assistant", "content": ans, "segments": ans_segments})
             
             with s3:
                 st.subheader("設定出題參數")
@@ -348,40 +2411,61 @@ with tab_study:
                 with c2: qt = st.radio("題型", ["MC","LQ"], horizontal=True)
                 with c3: num = st.number_input("數量", 1, 10, 1)
                 with c4: lang = st.selectbox("語言", ["中文 (繁體)", "English"], index=default_idx)
+                topic = st.text_input("出題範圍 (可留空)", placeholder="例如：光合作用、需求彈性")
+                parallel = st.checkbox("⚡ 平行生成 (每題獨立請求，較快)", value=True, disabled=num == 1)
                 
-                if st.button("🚀 生成題目"):
+                b_gen, b_regen, _ = st.columns([1, 1, 2])
+                with b_gen: gen_clicked = st.button("🚀 生成題目")
+                with b_regen: regen_clicked = st.button("🔁 重新生成", disabled=not st.session_state.get('llm_cache_on'), help="略過快取，重新呼叫 AI")
+                if gen_clicked or regen_clicked:
                     if not notes:
                         st.error("❌ 必須先提供【文字筆記】才能生成題目 (僅有音檔無法生成)")
                     else:
-                        prompt = f"""
-                        角色：香港考評局 DSE {current_subject} 出卷員。
-                        語言：請使用 **{lang}**。
-                        任務：根據筆記，設計 **{num} 條** {diff} 程度的 {qt}。
-                        【極重要格式指令】：
-                        1. **題目/答案分離**：先列出「試題卷 (Questions)」，插入 `<<<SPLIT>>>`，再列出「答案與詳解 (Marking Scheme)」。
-                        2. **MC 選項格式**：必須 **垂直分行**。
-                        3. **答案格式 (Highlight & Explanation)**：
-                           - 必須提供 **【詳細解釋 (Explanation)】**。
-                           - **正確答案的關鍵字或選項** 必須使用 HTML 黃色高亮語法包住：
-                             請使用: `<span class="highlight-answer">正確答案</span>`
-                        4. **數學公式**：
-                           - 行內公式用單個 $ 包住 (例如 $x^2$)。
-                           - 獨立公式用兩個 $$ 包住。
-                        筆記內容：{notes[:7000]}
-                        """
-                        res = client.chat.completions.create(model="deepseek-chat", messages=[{"role":"user","content":prompt}]).choices[0].message.content
-                        q_p, a_p = res.split("<<<SPLIT>>>") if "<<<SPLIT>>>" in res else (res, "AI 未能自動分離答案，請見上方。")
-                        st.session_state['q'] = {"q": q_p, "a": a_p}
+                        notes_context = select_notes_context(notes, topic, QUIZ_CONTEXT_TOKENS)
+                        if parallel and num > 1:
+                            bar = st.progress(0.0, text=f"⚡ 平行生成 {num} 條題目...")
+                            prompts = [build_quiz_prompt(current_subject, lang, 1, diff, qt, topic, notes_context, part=(i + 1, num)) for i in range(num)]
+                            st.session_state['q'] = generate_quiz_parallel(prompts, bypass_cache=regen_clicked, progress=bar)
+                        else:
+                            prompt = build_quiz_prompt(current_subject, lang, num, diff, qt, topic, notes_context)
+                            st.session_state['q'] = stream_quiz([{"role":"user","content":prompt}], bypass_cache=regen_clicked)
+                        # 生成完成後以正式版面重新顯示 (答案收起)
+                        st.rerun()
 
                 if 'q' in st.session_state:
                     quiz = st.session_state['q']
                     st.markdown("### 📝 試題")
-                    st.markdown(clean_latex(quiz['q']))
+                    render_rich(render_segments(quiz['q']))
                     st.info("👇 完成作答後，點擊下方查看詳解")
                     with st.expander("🔐 查看答案與詳細解釋 (Marking Scheme)"):
-                        st.markdown(clean_latex(quiz['a']), unsafe_allow_html=True)
+                        render_rich(render_segments(quiz['a']), unsafe_allow_html=True)
+                    embed_model.warm()
                     st.button("☁️ 加入題庫", key="sq", on_click=manual_save_to_cloud, args=(current_subject, quiz['q'], quiz['a'], "模擬卷"))
 
+            with s4:
+                st.subheader("📥 批次匯入 Q: ... A: ... 題目")
+                qa_pairs = list(iter_qa_pairs(notes.splitlines())) if notes else []
+                if not qa_pairs:
+                    st.info("筆記中找不到「Q: ... A: ...」格式的題目，可先用「🏭 資料清洗」的指令整理筆記。")
+                else:
+                    embed_model.warm()
+                    st.caption(f"找到 {len(qa_pairs)} 題，將匯入【{current_subject}】")
+                    with st.expander("👀 預覽前 5 題"):
+                        for pq, pa in qa_pairs[:5]:
+                            st.markdown(f"**Q:** {clean_latex(pq)}")
+                            st.markdown(f"**A:** {clean_latex(pa)}", unsafe_allow_html=True)
+                            st.divider()
+                    if st.button("📥 開始匯入", type="primary"):
+                        if not index:
+                            st.error("❌ 未連接題庫")
+                        else:
+                            bar = st.progress(0.0, text="準備匯入...")
+                            done, total, err = import_qa_cards(current_subject, qa_pairs, progress=bar)
+                            if err:
+                                st.error(f"匯入中斷 ({done}/{total})：{err}\n\n再按一次「開始匯入」會從中斷處繼續。")
+                            else:
+                                st.success(f"✅ 已匯入 {total} 題到【{current_subject}】")
+
 # ==========================================
 # TAB 3: 權重機率抽卡
 # ==========================================
@@ -391,11 +2475,94 @@ with tab_review:
     with c_act: st.button("⏭️ 下一張", on_click=skip_card, type="primary", use_container_width=True)
 
     if not index:
-        st.warning("⚠️ 請先設定 Pinecone Key")
+        st.warning("⚠️ 請先設定 Pinecone Key 或選用本地題庫")
+        finish_rerun()
         st.stop()
 
-    c_filt, c_space = st.columns([2, 3])
+    c_filt, c_sync, c_space = st.columns([2, 1, 2])
     with c_filt: f_sub = st.selectbox("📂 選擇學科", ["顯示全部", "Biology", "Chemistry", "Economics", "Chinese", "English", "History", "Maths"])
+    with c_sync:
+        st.write("")
+        st.button("🔄 同步題庫", on_click=resync_deck, use_container_width=True)
+    with c_space:
+        st.metric("📅 今日到期", deck_mirror.due_count(None if f_sub == "顯示全部" else f_sub, until=end_of_today()))
+
+    similar_results = st.session_state.get('similar_results')
+    with st.expander("🔍 相似題目", expanded=bool(similar_results)):
+        c_sq, c_sgo = st.columns([4, 1])
+        with c_sq: st.text_input("搜尋相似題目", key="sim_query", placeholder="輸入題目或關鍵字；留空則搜尋與目前卡片相似的題目", label_visibility="collapsed")
+        with c_sgo: st.button("🔍 搜尋", on_click=search_similar_cards, args=(None if f_sub == "顯示全部" else f_sub,), use_container_width=True)
+        if similar_results is not None and not similar_results:
+            st.caption("找不到相似的題目")
+        for score, cid in similar_results or []:
+            md = deck_mirror.get(cid)
+            if not md:
+                continue
+            c_txt, c_pick = st.columns([5, 1])
+            preview = " ".join((md.get('question') or "").split())[:120]
+            with c_txt: st.markdown(f"**{score:.0%}** · {md.get('subject')} · {preview}")
+            with c_pick: st.button("📌 溫習", key=f"sim_{cid}", on_click=pick_card, args=(cid,), use_container_width=True)
+
+    with st.expander("🗄️ 備份 / 遷移題庫"):
+        st.caption(f"Embedding 模型：{EMBED_MODEL_NAME} · " + ("本地題庫" if storage_backend == "💻 本地" else f"Pinecone 索引：{PINECONE_INDEX_NAME}"))
+        c_exp, c_imp = st.columns(2)
+        with c_exp:
+            st.markdown("**📤 匯出**")
+            if st.button("準備匯出檔", use_container_width=True):
+                bar = st.progress(0.0, text="📤 匯出中...")
+                try:
+                    write_queue.flush()
+                    with tracer.span("deck.export") as rec:
+                        st.session_state['deck_export'] = export_deck(index, EMBED_MODEL_NAME, progress=bar)
+                        rec["bytes"] = len(st.session_state['deck_export'])
+                except Exception as e:
+                    st.error(f"匯出失敗: {e}")
+                bar.empty()
+            if 'deck_export' in st.session_state:
+                st.download_button("💾 下載題庫 (.zip)", st.session_state['deck_export'], file_name=f"dse_deck_{datetime.date.today()}.zip",
+                                   mime="application/zip", use_container_width=True)
+        with c_imp:
+            st.markdown("**📥 還原**")
+            bundle = st.file_uploader("題庫匯出檔 (.zip)", type=["zip"], key="deck_bundle", label_visibility="collapsed")
+            if bundle and st.button("還原到目前題庫", use_container_width=True):
+                bar = st.progress(0.0, text="📥 還原中...")
+                try:
+                    done, total, reembed = restore_deck(bundle.getvalue(), progress=bar)
+                    st.success(f"✅ 已還原 {total} 張卡" + ("（已按目前的模型重新編碼）" if reembed else ""))
+                except Exception as e:
+                    st.error(f"還原中斷：{e}（再按一次會從中斷處繼續）")
+                bar.empty()
+
+        st.divider()
+        st.markdown("**🔁 遷移到新的 embedding 模型**")
+        c_model, c_target = st.columns(2)
+        with c_model: new_model = st.text_input("新模型 (sentence-transformers 名稱)", value=EMBED_MODEL_NAME, key="migrate_model").strip()
+        with c_target:
+            if storage_backend == "💻 本地":
+                new_target = local_store_root(new_model)
+                st.text_input("目標本地題庫", value=os.path.relpath(new_target, APP_DIR), disabled=True)
+            else:
+                new_target = st.text_input("目標 Pinecone 索引 (需先以新模型的維度建立)", value=PINECONE_INDEX_NAME, key="migrate_index").strip()
+        if st.button("🔁 開始 / 繼續遷移"):
+            current_target = local_store_root(EMBED_MODEL_NAME) if storage_backend == "💻 本地" else PINECONE_INDEX_NAME
+            if not new_model or (new_model == EMBED_MODEL_NAME and new_target == current_target):
+                st.warning("新模型及目標與目前的題庫相同，毋須遷移")
+            else:
+                bar = st.progress(0.0, text="🔁 遷移中...")
+                try:
+                    if storage_backend == "💻 本地":
+                        target = NamespacedIndex(init_local_store(new_target), namespace, tracer)
+                    else:
+                        target = NamespacedIndex(init_pinecone_index(pinecone_key, new_target), namespace, tracer)
+                    write_queue.flush()
+                    job_id = "migrate-" + hashlib.sha256(json.dumps([backend_key, namespace, new_model, new_target]).encode()).hexdigest()[:16]
+                    done, total = migrate_deck(target, new_model, job_id, progress=bar)
+                    settings = f"EMBED_MODEL = \"{new_model}\"" + ("" if storage_backend == "💻 本地" else f"\nPINECONE_INDEX = \"{new_target}\"")
+                    st.success(f"✅ 已遷移 {total} 張卡。請在 secrets 設定以下項目後重新啟動：")
+                    st.code(settings, language="toml")
+                except Exception as e:
+                    st.error(f"遷移中斷：{e}（再按一次會從中斷處繼續）")
+                bar.empty()
 
     if 'last_filter' not in st.session_state: st.session_state.last_filter = f_sub
     if st.session_state.last_filter != f_sub:
@@ -406,12 +2573,20 @@ with tab_review:
 
     try:
         if 'card_pool' not in st.session_state:
-            dummy = [0.0] * 384
-            meta_filter = {"subject": f_sub} if f_sub != "顯示全部" else None
-            top_k_count = 500 if f_sub == "顯示全部" else 200
-            with st.spinner(f"載入題庫..."):
-                res = index.query(vector=dummy, top_k=top_k_count, include_metadata=True, filter=meta_filter)
-                st.session_state['card_pool'] = res['matches']
+            # 每個 session 只同步一次，之後切換學科直接讀本地鏡像
+            if not st.session_state.get('deck_synced'):
+                with st.spinner(f"同步題庫..."):
+                    with tracer.span("write_queue.flush", items=write_queue.pending()):
+                        write_queue.flush()
+                    with tracer.span("deck.sync") as rec:
+                        added, removed = deck_mirror.sync(index, pending=write_queue.pending_ids())
+                        rec.update(added=added, removed=removed)
+                st.session_state['deck_synced'] = True
+                if added or removed:
+                    st.toast(f"🔄 題庫已同步：新增/更新 {added}，移除 {removed}", icon="☁️")
+            with tracer.span("deck.pool") as rec:
+                refresh_card_pool()
+                rec["cards"] = len(st.session_state['card_pool'])
 
         pool = st.session_state['card_pool']
 
@@ -419,15 +2594,8 @@ with tab_review:
             st.info(f"📭 題庫中暫時沒有【{f_sub}】的紀錄。")
         else:
             if 'current_card_data' not in st.session_state:
-                weights = [float(m['metadata'].get('weight', 20.0)) for m in pool]
-                chosen_card = random.choices(pool, weights=weights, k=1)[0]
-                if len(pool) > 1 and 'previous_card_id' in st.session_state:
-                    prev_id = st.session_state['previous_card_id']
-                    retry = 0
-                    while chosen_card['id'] == prev_id and retry < 5:
-                        chosen_card = random.choices(pool, weights=weights, k=1)[0]
-                        retry += 1
-                st.session_state['current_card_data'] = chosen_card
+                with tracer.span("deck.draw", pool=len(pool)):
+                    st.session_state['current_card_data'] = draw_next_card()
 
             card = st.session_state['current_card_data']
             data = card['metadata']
@@ -435,7 +2603,6 @@ with tab_review:
 
             subject = data.get('subject')
             question_text = data.get('question', '')
-            cleaned_question = clean_latex(question_text)
 
             st.markdown(f"""
             <div class="flashcard">
@@ -443,16 +2610,7 @@ with tab_review:
                 <div class="card-question">
             """, unsafe_allow_html=True)
 
-            if '$$' in cleaned_question:
-                parts = re.split(r'(\$\$.*?\$\$)', cleaned_question, flags=re.DOTALL)
-                for part in parts:
-                    if part.startswith('$$') and part.endswith('$$'):
-                        st.latex(part.replace('$$', ''))
-                    else:
-                        if part.strip():
-                            st.write(part)
-            else:
-                st.write(cleaned_question)
+            render_rich(render_segments(question_text))
 
             st.markdown("""
                 </div>
@@ -461,7 +2619,7 @@ with tab_review:
 
             with st.expander("👁️ 翻開詳解 (Show Detail)", expanded=False):
                 st.markdown("### ✅ 詳細解析")
-                st.markdown(clean_latex(data.get('answer')), unsafe_allow_html=True)
+                render_rich(render_segments(data.get('answer') or ""), unsafe_allow_html=True)
                 st.divider()
                 st.markdown("<div style='text-align: center; color: grey; margin-bottom: 10px;'>這題你覺得？</div>", unsafe_allow_html=True)
                 _, col_btns, _ = st.columns([1, 4, 1])
@@ -474,3 +2632,5 @@ with tab_review:
 
     except Exception as e:
         st.error(f"系統錯誤: {e}")
+
+finish_rerun()
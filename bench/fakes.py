@@ -0,0 +1,217 @@
+"""
+基準測試用的本地替身：
+- FakeIndex / FakePinecone：以 vector_store.LocalVectorStore 模擬的 Pinecone Index，每次呼叫可加上固定延遲
+- FakeLLMServer：本地 HTTP 伺服器，模擬 DeepSeek (OpenAI 相容) 的 /chat/completions，支援串流
+- FakeSentenceTransformer：以文字 hash 產生固定向量，免去下載模型
+"""
+import hashlib
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import types
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from vector_store import LocalVectorStore  # noqa: E402
+
+SUBJECTS = ["Biology", "Chemistry", "Economics", "Chinese", "English", "History", "Maths"]
+
+
+class FakeIndex(LocalVectorStore):
+    """
+    以 LocalVectorStore (存於臨時目錄) 模擬 Pinecone Index，行為與 app 的本地後端一致；
+    latency 為每次呼叫的延遲 (秒)，calls 記錄各方法的呼叫次數
+    """
+    def __init__(self, dim=384, latency=0.0):
+        self.tmpdir = tempfile.mkdtemp(prefix="dse-fake-index-")
+        super().__init__(self.tmpdir, dim=dim)
+        self.latency = latency
+        self.calls = {}
+
+    def _call(self, name):
+        self.calls[name] = self.calls.get(name, 0) + 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def close(self):
+        self.db.close()
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def upsert(self, vectors, namespace='', **kwargs):
+        self._call('upsert')
+        return super().upsert(vectors, namespace=namespace, **kwargs)
+
+    def update(self, id, values=None, set_metadata=None, namespace='', **kwargs):
+        self._call('update')
+        return super().update(id, values=values, set_metadata=set_metadata, namespace=namespace, **kwargs)
+
+    def delete(self, ids=None, delete_all=False, filter=None, namespace='', **kwargs):
+        self._call('delete')
+        return super().delete(ids=ids, delete_all=delete_all, filter=filter, namespace=namespace, **kwargs)
+
+    def query(self, vector=None, top_k=10, filter=None, include_metadata=False, include_values=False, namespace='', id=None, **kwargs):
+        self._call('query')
+        return super().query(vector=vector, top_k=top_k, filter=filter, include_metadata=include_metadata,
+                             include_values=include_values, namespace=namespace, id=id, **kwargs)
+
+    def fetch(self, ids, namespace='', **kwargs):
+        self._call('fetch')
+        return super().fetch(ids, namespace=namespace, **kwargs)
+
+    def list_paginated(self, limit=100, pagination_token=None, namespace='', prefix=None, **kwargs):
+        self._call('list')
+        return super().list_paginated(limit=limit, pagination_token=pagination_token, namespace=namespace, prefix=prefix, **kwargs)
+
+    def describe_index_stats(self, **kwargs):
+        self._call('describe_index_stats')
+        return super().describe_index_stats(**kwargs)
+
+
+def seed_deck(index, size, namespace='', seed=0):
+    """產生 size 張合成卡片 (隨機學科、權重及向量)；直接寫入，不計入 calls 亦沒有延遲"""
+    rng = np.random.default_rng(seed)
+    vectors = rng.standard_normal((size, index.dim), dtype=np.float32)
+    now = time.time()
+    weights = [20.0, 5.0, 1.0]
+    items = [(f"card-{i:06d}", vectors[i], {
+        "subject": SUBJECTS[i % len(SUBJECTS)],
+        "question": f"Q{i}: 以下哪一項描述 $x^{i % 7}$ 的性質？\\[ \\int_0^1 x^{i % 7} dx \\]",
+        "answer": f"A{i}: <span class=\"highlight-answer\">答案</span> 詳細解釋……",
+        "type": "問答", "date_added": "2024-01-01",
+        "weight": weights[i % 3], "timestamp": now - (size - i),
+    }) for i in range(size)]
+    LocalVectorStore.upsert(index, items, namespace=namespace)
+
+
+class FakePinecone:
+    """取代 pinecone.Pinecone：所有 Index() 都回傳同一個 FakeIndex"""
+    index = None
+
+    def __init__(self, api_key=None, **kwargs):
+        pass
+
+    def Index(self, name, **kwargs):
+        return FakePinecone.index
+
+
+class FakeSentenceTransformer:
+    """以文字 hash 為種子產生固定的 384 維向量"""
+    def __init__(self, model_name=None, dim=384):
+        self.dim = dim
+
+    def _one(self, text):
+        seed = int.from_bytes(hashlib.sha256(text.encode('utf-8')).digest()[:8], 'little')
+        return np.random.default_rng(seed).standard_normal(self.dim, dtype=np.float32)
+
+    def encode(self, sentences, batch_size=32, convert_to_numpy=True, **kwargs):
+        if isinstance(sentences, str):
+            return self._one(sentences)
+        return np.stack([self._one(s) for s in sentences]) if sentences else np.zeros((0, self.dim), dtype=np.float32)
+
+    def get_sentence_embedding_dimension(self):
+        return self.dim
+
+
+def install_fake_embedder():
+    module = types.ModuleType('sentence_transformers')
+    module.SentenceTransformer = FakeSentenceTransformer
+    sys.modules['sentence_transformers'] = module
+
+
+def install_fake_pinecone(index):
+    import pinecone
+    FakePinecone.index = index
+    pinecone.Pinecone = FakePinecone
+
+
+DEFAULT_REPLY = (
+    "1. 以下哪一項正確？\n\nA. 甲\n\nB. 乙\n\nC. 丙\n\nD. 丁\n\n"
+    "<<<SPLIT>>>\n\n1. <span class=\"highlight-answer\">B</span>\n\n【詳細解釋】因為 $$E = mc^2$$，所以……"
+)
+
+
+class FakeLLMServer:
+    """
+    本地 OpenAI 相容伺服器 (POST /chat/completions)：
+    latency 為首個 token 前的延遲，token_delay 為串流時每個 token 之間的延遲
+    """
+    def __init__(self, latency=0.2, token_delay=0.0, reply=DEFAULT_REPLY, chunk_chars=4):
+        self.latency = latency
+        self.token_delay = token_delay
+        self.reply = reply
+        self.chunk_chars = chunk_chars
+        self.requests = 0
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b"{}")
+                server.requests += 1
+                time.sleep(server.latency)
+                prompt_tokens = sum(len(m.get('content', '')) for m in body.get('messages', [])) // 2
+                usage = {"prompt_tokens": prompt_tokens, "completion_tokens": len(server.reply) // 2,
+                         "total_tokens": prompt_tokens + len(server.reply) // 2}
+                base = {"id": "chatcmpl-bench", "created": int(time.time()), "model": body.get('model', 'deepseek-chat')}
+                if body.get('stream'):
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'text/event-stream')
+                    self.send_header('Transfer-Encoding', 'chunked')
+                    self.end_headers()
+                    reply = server.reply
+                    for i in range(0, len(reply), server.chunk_chars):
+                        chunk = dict(base, object="chat.completion.chunk",
+                                     choices=[{"index": 0, "delta": {"content": reply[i:i + server.chunk_chars]}, "finish_reason": None}])
+                        self._write_chunk(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n")
+                        if server.token_delay:
+                            time.sleep(server.token_delay)
+                    last = dict(base, object="chat.completion.chunk",
+                                choices=[{"index": 0, "delta": {}, "finish_reason": "stop"}], usage=usage)
+                    self._write_chunk(f"data: {json.dumps(last)}\n\n")
+                    self._write_chunk("data: [DONE]\n\n")
+                    self.wfile.write(b"0\r\n\r\n")
+                else:
+                    payload = json.dumps(dict(base, object="chat.completion", usage=usage, choices=[
+                        {"index": 0, "message": {"role": "assistant", "content": server.reply}, "finish_reason": "stop"}
+                    ]), ensure_ascii=False).encode('utf-8')
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'application/json')
+                    self.send_header('Content-Length', str(len(payload)))
+                    self.end_headers()
+                    self.wfile.write(payload)
+
+            def _write_chunk(self, text):
+                data = text.encode('utf-8')
+                self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+                self.wfile.flush()
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.httpd.daemon_threads = True
+        self.base_url = f"http://127.0.0.1:{self.httpd.server_address[1]}"
+        threading.Thread(target=self.httpd.serve_forever, daemon=True, name="fake-llm").start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def random_notes(sections=40, seed=0):
+    """合成筆記 (Markdown 標題 + 段落 + Q/A)，用於問答 / prompt 組裝的測試"""
+    rnd = random.Random(seed)
+    words = ["細胞", "membrane", "光合作用", "enzyme", "能量", "ATP", "diffusion", "滲透", "respiration", "葡萄糖"]
+    parts = []
+    for i in range(sections):
+        parts.append(f"# Topic {i}\n## Sub {i}\n" + " ".join(rnd.choice(words) for _ in range(300)))
+        parts.append(f"Q: 問題 {i}？\nA: 答案 {i} \\( x^{i} \\)")
+    return "\n\n".join(parts)
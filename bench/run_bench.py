@@ -0,0 +1,239 @@
+"""
+DSE Study App 基準測試：以 Streamlit AppTest 在本地替身 (FakeIndex / FakeLLMServer) 上跑整個 app，
+量度各熱點路徑每次 rerun 的 p50 / p95 延遲及記憶體用量。
+
+    python bench/run_bench.py --sizes 100,1000,10000,50000
+    python bench/run_bench.py --save-baseline          # 將結果存成 bench/baseline.json
+    python bench/run_bench.py --tolerance 0.3          # 比 baseline 慢 30% 以上即回傳 1
+
+場景：
+- cold_start：清空快取及鏡像後首次載入 (包括由雲端完整同步題庫)
+- warm_start：新 session，快取及鏡像已在磁碟 (抽卡池由鏡像重建)
+- draw：按「⏭️ 下一張」
+- rate：按「✅ 記得了」(update_weight)
+- save：按模擬卷的「☁️ 加入題庫」(manual_save_to_cloud)
+- chat：問答 (select_notes_context + clean_latex + 串流回覆)
+"""
+import argparse
+import gc
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+RESULTS_DIR = os.path.join(BENCH_DIR, "results")
+BASELINE_PATH = os.path.join(BENCH_DIR, "baseline.json")
+sys.path.insert(0, BENCH_DIR)
+
+import fakes  # noqa: E402
+
+SCENARIOS = ["cold_start", "warm_start", "draw", "rate", "save", "chat"]
+# 低於此絕對差距 (毫秒) 的變慢視為雜訊
+MIN_REGRESSION_MS = 5.0
+
+
+def rss_mb():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+    except OSError:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    k = (len(ordered) - 1) * pct / 100
+    lo, hi = int(k), min(int(k) + 1, len(ordered) - 1)
+    return ordered[lo] + (ordered[hi] - ordered[lo]) * (k - lo)
+
+
+class Bench:
+    def __init__(self, args, workdir, llm):
+        self.args = args
+        self.workdir = workdir
+        self.app_path = os.path.join(workdir, "app.py")
+        self.llm = llm
+
+    def new_app(self):
+        from streamlit.testing.v1 import AppTest
+        at = AppTest.from_file(self.app_path, default_timeout=self.args.timeout)
+        at.secrets["DEEPSEEK_API_KEY"] = "bench"
+        at.secrets["DEEPSEEK_BASE_URL"] = self.llm.base_url
+        at.secrets["PINECONE_API_KEY"] = "bench"
+        return at
+
+    @staticmethod
+    def timed(step):
+        t0 = time.perf_counter()
+        at = step()
+        elapsed = (time.perf_counter() - t0) * 1000
+        if at.exception:
+            raise RuntimeError("; ".join(e.message for e in at.exception))
+        errors = [e.value for e in at.error]
+        if errors:
+            raise RuntimeError("; ".join(errors))
+        return elapsed
+
+    def reset_caches(self):
+        import streamlit as st
+        st.cache_resource.clear()
+        st.cache_data.clear()
+        for name in (".deck_cache", ".local_store", ".llm_cache", ".embed_cache"):
+            shutil.rmtree(os.path.join(self.workdir, name), ignore_errors=True)
+        gc.collect()
+
+    @staticmethod
+    def button(at, label):
+        return next(b for b in at.button if b.label == label)
+
+    def with_notes(self, at):
+        at.run()
+        for r in at.radio:
+            if r.label == "來源":
+                r.set_value("📋 貼上文字")
+        at.run()
+        for t in at.text_area:
+            if t.label == "貼上筆記：":
+                t.input(self.notes)
+        return at
+
+    def run_size(self, size):
+        repeats = self.args.repeats
+        fakes.FakePinecone.index = index = fakes.FakeIndex(latency=self.args.pinecone_latency / 1000)
+        fakes.seed_deck(index, size)
+        self.notes = fakes.random_notes()
+        samples = {name: [] for name in SCENARIOS}
+
+        # 冷啟動次數較少 (每次都要完整同步)
+        for _ in range(max(1, repeats // 5)):
+            self.reset_caches()
+            samples["cold_start"].append(self.timed(self.new_app().run))
+
+        for _ in range(repeats):
+            samples["warm_start"].append(self.timed(self.new_app().run))
+
+        at = self.new_app()
+        at.run()
+        for _ in range(repeats):
+            samples["draw"].append(self.timed(lambda: self.button(at, "⏭️ 下一張").click().run()))
+        for _ in range(repeats):
+            samples["rate"].append(self.timed(lambda: at.button(key="easy").click().run()))
+
+        at = self.with_notes(self.new_app())
+        at.run()
+        for i in range(repeats):
+            at.session_state["q"] = {"q": f"Bench question {i} $x^{i}$", "a": f"Bench answer {i}"}
+            at.run()
+            samples["save"].append(self.timed(lambda: at.button(key="sq").click().run()))
+        for i in range(repeats):
+            samples["chat"].append(self.timed(lambda: at.chat_input[0].set_value(f"什麼是 ATP？#{i}").run()))
+        spans = at.session_state["perf_tracer"].summary()
+        at = None
+
+        result = {}
+        for name, values in samples.items():
+            result[name] = {"p50_ms": round(percentile(values, 50), 2), "p95_ms": round(percentile(values, 95), 2),
+                            "n": len(values)}
+        gc.collect()
+        result["memory"] = {"rss_mb": round(rss_mb(), 1), "warm_start_peak_mb": round(self.traced_warm_start(), 1)}
+        result["pinecone_calls"] = dict(index.calls)
+        result["spans"] = spans
+        index.close()
+        return result
+
+    def traced_warm_start(self):
+        """以 tracemalloc 量度一次 warm_start 的 Python 記憶體峰值 (另外跑，避免拖慢延遲量度)"""
+        at = self.new_app()
+        tracemalloc.start()
+        try:
+            at.run()
+            return tracemalloc.get_traced_memory()[1] / 2 ** 20
+        finally:
+            tracemalloc.stop()
+
+
+def compare(results, baseline, tolerance):
+    """回傳 [(key, baseline_p95, p95)]：p95 比 baseline 慢超過 tolerance (及 MIN_REGRESSION_MS)"""
+    regressions = []
+    for size, scenarios in results["sizes"].items():
+        for name in SCENARIOS:
+            old = baseline.get("sizes", {}).get(size, {}).get(name)
+            new = scenarios.get(name)
+            if not old or not new:
+                continue
+            if new["p95_ms"] > old["p95_ms"] * (1 + tolerance) and new["p95_ms"] - old["p95_ms"] > MIN_REGRESSION_MS:
+                regressions.append((f"{size}/{name}", old["p95_ms"], new["p95_ms"]))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="100,1000,10000,50000", help="題庫大小 (逗號分隔)")
+    parser.add_argument("--repeats", type=int, default=20, help="每個場景的 rerun 次數")
+    parser.add_argument("--pinecone-latency", type=float, default=20.0, help="每次 Pinecone 呼叫的延遲 (毫秒)")
+    parser.add_argument("--llm-latency", type=float, default=200.0, help="LLM 首個 token 前的延遲 (毫秒)")
+    parser.add_argument("--llm-token-delay", type=float, default=2.0, help="LLM 串流每個 token 的延遲 (毫秒)")
+    parser.add_argument("--timeout", type=float, default=600.0, help="每次 AppTest rerun 的上限 (秒)")
+    parser.add_argument("--real-embedder", action="store_true", help="使用真正的 sentence-transformers 模型")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="p95 比 baseline 慢多少 (比例) 算退步")
+    parser.add_argument("--save-baseline", action="store_true", help="將結果寫入 bench/baseline.json")
+    args = parser.parse_args()
+
+    if not args.real_embedder:
+        fakes.install_fake_embedder()
+    fakes.install_fake_pinecone(None)
+    llm = fakes.FakeLLMServer(latency=args.llm_latency / 1000, token_delay=args.llm_token_delay / 1000)
+
+    # 在臨時目錄執行 app 副本，快取 / 鏡像檔案不會污染工作目錄
+    workdir = tempfile.mkdtemp(prefix="dse-bench-")
+    for name in ("app.py", "vector_store.py", "ocr_worker.py"):
+        shutil.copy(os.path.join(REPO_DIR, name), workdir)
+    bench = Bench(args, workdir, llm)
+    results = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "config": {k: v for k, v in vars(args).items() if k not in ("save_baseline", "tolerance")},
+        "sizes": {},
+    }
+    try:
+        for size in (int(s) for s in args.sizes.split(",")):
+            print(f"== {size} 張卡片", flush=True)
+            results["sizes"][str(size)] = res = bench.run_size(size)
+            for name in SCENARIOS:
+                print(f"  {name:<11} p50 {res[name]['p50_ms']:>9.1f} ms   p95 {res[name]['p95_ms']:>9.1f} ms   (n={res[name]['n']})")
+            print(f"  memory      rss {res['memory']['rss_mb']} MB   warm_start peak {res['memory']['warm_start_peak_mb']} MB", flush=True)
+    finally:
+        llm.close()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    out_path = os.path.join(RESULTS_DIR, time.strftime("bench-%Y%m%d-%H%M%S.json"))
+    with open(out_path, "w", encoding="utf-8") as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+    print(f"結果已儲存：{out_path}")
+
+    if args.save_baseline:
+        with open(BASELINE_PATH, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+        print(f"已更新 baseline：{BASELINE_PATH}")
+        return 0
+    if not os.path.exists(BASELINE_PATH):
+        print("（未有 baseline，可用 --save-baseline 建立）")
+        return 0
+    with open(BASELINE_PATH, encoding="utf-8") as f:
+        regressions = compare(results, json.load(f), args.tolerance)
+    for key, old, new in regressions:
+        print(f"⚠️ 退步：{key} p95 {old:.1f} → {new:.1f} ms")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,36 @@
+"""
+OCR 的 worker 函數，於 app.py 的 ProcessPoolExecutor 子程序中執行：
+PyMuPDF 不支援多線程，每個程序各自開啟 PDF；檔案內容在程序啟動時 (init_worker) 傳入一次，不會每頁重複傳送
+"""
+import io
+
+_data = None
+_doc = None
+
+
+def init_worker(data):
+    global _data, _doc
+    _data, _doc = data, None
+
+
+def ocr_pdf_page(page_no, lang, dpi, text_layer_min_chars):
+    """轉換單頁 PDF 為灰階圖再交給 tesseract；頁面本身有文字層時直接取用"""
+    global _doc
+    import pymupdf
+    import pytesseract
+    from PIL import Image
+    if _doc is None:
+        _doc = pymupdf.open(stream=_data, filetype="pdf")
+    page = _doc[page_no]
+    text = page.get_text()
+    if len(text.strip()) >= text_layer_min_chars:
+        return text
+    pix = page.get_pixmap(dpi=dpi, colorspace=pymupdf.csGRAY)
+    img = Image.frombytes("L", (pix.width, pix.height), pix.samples)
+    return pytesseract.image_to_string(img, lang=lang)
+
+
+def ocr_image(_page_no, lang, _dpi=None, _text_layer_min_chars=None):
+    import pytesseract
+    from PIL import Image
+    return pytesseract.image_to_string(Image.open(io.BytesIO(_data)), lang=lang)
@@ -0,0 +1,244 @@
+"""
+本地向量庫及 Pinecone metadata filter 的實作；app.py 的「💻 本地」後端與 bench/fakes.py 的 FakeIndex 共用
+"""
+import bisect
+import itertools
+import json
+import os
+import sqlite3
+import threading
+import types
+
+import numpy as np
+
+LEGACY_LOCAL_DIM = 384        # 未記錄維度的舊本地題庫 (all-MiniLM-L6-v2)
+
+def match_metadata_filter(metadata, flt):
+    """以 Pinecone 的 metadata filter 語法 ($eq/$ne/$gt/$gte/$lt/$lte/$in/$nin/$and/$or) 檢查一張卡"""
+    if not flt:
+        return True
+    for key, cond in flt.items():
+        if key == '$and':
+            if not all(match_metadata_filter(metadata, c) for c in cond): return False
+            continue
+        if key == '$or':
+            if not any(match_metadata_filter(metadata, c) for c in cond): return False
+            continue
+        value = metadata.get(key)
+        if not isinstance(cond, dict):
+            cond = {'$eq': cond}
+        for op, target in cond.items():
+            if op == '$eq': ok = value == target
+            elif op == '$ne': ok = value != target
+            elif op == '$in': ok = value in target
+            elif op == '$nin': ok = value not in target
+            elif value is None: ok = False
+            elif op == '$gt': ok = value > target
+            elif op == '$gte': ok = value >= target
+            elif op == '$lt': ok = value < target
+            elif op == '$lte': ok = value <= target
+            else: raise ValueError(f"不支援的 filter 運算子: {op}")
+            if not ok:
+                return False
+    return True
+
+class LocalVectorStore:
+    """
+    本地向量庫 (Pinecone Index 的替身)：
+    向量存於 memory-mapped float32 陣列，metadata 存於 SQLite，
+    提供與 Index 相同的 upsert / update / delete / query / fetch / list_paginated
+    """
+    def __init__(self, root, dim=None, initial_capacity=1024):
+        """dim：向量維度；不指定時沿用庫內的紀錄，全新的庫則按第一次 upsert 的向量決定"""
+        os.makedirs(root, exist_ok=True)
+        self.lock = threading.RLock()
+        self.db = sqlite3.connect(os.path.join(root, "meta.sqlite"), check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS cards (namespace TEXT NOT NULL, id TEXT NOT NULL, row INTEGER NOT NULL, metadata TEXT NOT NULL, PRIMARY KEY (namespace, id))")
+        self.db.execute("CREATE TABLE IF NOT EXISTS info (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        self.db.commit()
+        stored = self.db.execute("SELECT value FROM info WHERE key = 'dim'").fetchone()
+        stored = int(stored[0]) if stored else None
+        if stored and dim and stored != dim:
+            raise ValueError(f"本地題庫的向量維度為 {stored}，與 {dim} 不符")
+        self.rows = {}  # (namespace, id) -> row
+        self.keys = {}  # row -> (namespace, id)
+        self.meta = {}  # row -> metadata
+        self.sorted_ids = {}  # namespace -> 排序後的 ID (list_paginated 用；新增 / 刪除時作廢)
+        for ns, cid, row, md in self.db.execute("SELECT namespace, id, row, metadata FROM cards"):
+            self.rows[(ns, cid)] = row
+            self.keys[row] = (ns, cid)
+            self.meta[row] = json.loads(md)
+
+        self.vec_path = os.path.join(root, "vectors.f32")
+        self.initial_capacity = initial_capacity
+        self.dim = None
+        self.vectors = np.zeros((0, 0), dtype=np.float32)
+        self.alive = np.zeros(0, dtype=bool)
+        self.norms = np.zeros(0, dtype=np.float32)
+        self.free = []
+        dim = stored or dim or (LEGACY_LOCAL_DIM if self.keys else None)
+        if dim:
+            self._open(dim)
+
+    def _open(self, dim):
+        """確定維度後才建立 / 開啟向量檔"""
+        self.dim = dim
+        self.db.execute("INSERT OR REPLACE INTO info (key, value) VALUES ('dim', ?)", (str(dim),))
+        self.db.commit()
+        row_bytes = dim * 4
+        on_disk = os.path.getsize(self.vec_path) // row_bytes if os.path.exists(self.vec_path) else 0
+        capacity = max(self.initial_capacity, on_disk, max(self.keys, default=-1) + 1)
+        self._resize_file(capacity)
+        self.vectors = np.memmap(self.vec_path, dtype=np.float32, mode='r+', shape=(capacity, dim))
+        self.alive = np.zeros(capacity, dtype=bool)
+        self.alive[list(self.keys)] = True
+        self.norms = np.linalg.norm(self.vectors, axis=1).astype(np.float32)
+        self.free = [r for r in range(capacity - 1, -1, -1) if not self.alive[r]]
+
+    def _check_dim(self, values):
+        if self.dim is None:
+            self._open(len(values))
+        elif len(values) != self.dim:
+            raise ValueError(f"向量維度 {len(values)} 與本地題庫的 {self.dim} 不符")
+
+    def _resize_file(self, capacity):
+        with open(self.vec_path, 'ab') as fp:
+            if fp.tell() < capacity * self.dim * 4:
+                fp.truncate(capacity * self.dim * 4)
+
+    def _grow(self):
+        old = len(self.alive)
+        capacity = old * 2
+        self.vectors.flush()
+        del self.vectors
+        self._resize_file(capacity)
+        self.vectors = np.memmap(self.vec_path, dtype=np.float32, mode='r+', shape=(capacity, self.dim))
+        self.alive = np.concatenate([self.alive, np.zeros(capacity - old, dtype=bool)])
+        self.norms = np.concatenate([self.norms, np.zeros(capacity - old, dtype=np.float32)])
+        self.free.extend(range(capacity - 1, old - 1, -1))
+
+    def _rows_for(self, namespace, flt=None):
+        rows = [r for r, (ns, _) in self.keys.items() if ns == namespace]
+        if flt:
+            rows = [r for r in rows if match_metadata_filter(self.meta[r], flt)]
+        return np.array(rows, dtype=np.int64)
+
+    def _write_meta(self, namespace, cid, row):
+        self.db.execute("INSERT OR REPLACE INTO cards (namespace, id, row, metadata) VALUES (?, ?, ?, ?)",
+                        (namespace, cid, int(row), json.dumps(self.meta[row], ensure_ascii=False)))
+
+    def upsert(self, vectors, namespace='', **kwargs):
+        with self.lock:
+            for item in vectors:
+                if isinstance(item, dict):
+                    cid, values, metadata = item['id'], item['values'], item.get('metadata') or {}
+                else:
+                    cid, values = item[0], item[1]
+                    metadata = item[2] if len(item) > 2 else {}
+                self._check_dim(values)
+                row = self.rows.get((namespace, cid))
+                if row is None:
+                    if not self.free:
+                        self._grow()
+                    row = self.free.pop()
+                    self.sorted_ids.pop(namespace, None)
+                    self.rows[(namespace, cid)] = row
+                    self.keys[row] = (namespace, cid)
+                    self.alive[row] = True
+                self.vectors[row] = np.asarray(values, dtype=np.float32)
+                self.norms[row] = np.linalg.norm(self.vectors[row])
+                self.meta[row] = dict(metadata)
+                self._write_meta(namespace, cid, row)
+            self.vectors.flush()
+            self.db.commit()
+        return {"upserted_count": len(vectors)}
+
+    def update(self, id, values=None, set_metadata=None, namespace='', **kwargs):
+        with self.lock:
+            row = self.rows.get((namespace, id))
+            if row is None:
+                return {}
+            if values is not None:
+                self._check_dim(values)
+                self.vectors[row] = np.asarray(values, dtype=np.float32)
+                self.norms[row] = np.linalg.norm(self.vectors[row])
+                self.vectors.flush()
+            if set_metadata:
+                self.meta[row].update(set_metadata)
+            self._write_meta(namespace, id, row)
+            self.db.commit()
+        return {}
+
+    def delete(self, ids=None, delete_all=False, filter=None, namespace='', **kwargs):
+        with self.lock:
+            if delete_all or filter:
+                ids = [self.keys[r][1] for r in self._rows_for(namespace, filter)]
+            for cid in ids or []:
+                row = self.rows.pop((namespace, cid), None)
+                if row is None:
+                    continue
+                del self.keys[row], self.meta[row]
+                self.sorted_ids.pop(namespace, None)
+                self.alive[row] = False
+                self.norms[row] = 0.0
+                self.free.append(row)
+                self.db.execute("DELETE FROM cards WHERE namespace = ? AND id = ?", (namespace, cid))
+            self.db.commit()
+        return {}
+
+    def query(self, vector=None, top_k=10, filter=None, include_metadata=False, include_values=False, namespace='', id=None, **kwargs):
+        with self.lock:
+            if vector is None and id is not None:
+                vector = self.vectors[self.rows[(namespace, id)]]
+            rows = self._rows_for(namespace, filter)
+            if not len(rows):
+                return {"matches": []}
+            q = np.asarray(vector, dtype=np.float32)
+            denom = self.norms[rows] * np.linalg.norm(q)
+            scores = np.divide(self.vectors[rows] @ q, denom, out=np.zeros(len(rows), dtype=np.float32), where=denom > 0)
+            k = min(top_k, len(rows))
+            top = np.argpartition(-scores, k - 1)[:k]
+            top = top[np.argsort(-scores[top], kind='stable')]
+            matches = []
+            for i in top:
+                row = rows[i]
+                m = {"id": self.keys[row][1], "score": float(scores[i])}
+                if include_metadata: m["metadata"] = dict(self.meta[row])
+                if include_values: m["values"] = self.vectors[row].tolist()
+                matches.append(m)
+            return {"matches": matches, "namespace": namespace}
+
+    def fetch(self, ids, namespace='', **kwargs):
+        with self.lock:
+            found = {}
+            for cid in ids:
+                row = self.rows.get((namespace, cid))
+                if row is not None:
+                    found[cid] = types.SimpleNamespace(id=cid, values=self.vectors[row].tolist(), metadata=dict(self.meta[row]))
+            return types.SimpleNamespace(vectors=found, namespace=namespace)
+
+    def list_paginated(self, limit=100, pagination_token=None, namespace='', prefix=None, **kwargs):
+        with self.lock:
+            ids = self.sorted_ids.get(namespace)
+            if ids is None:
+                ids = self.sorted_ids[namespace] = sorted(cid for ns, cid in self.rows if ns == namespace)
+        # 作廢時換成新的 list，不會原地修改，鎖外讀取 ids 是安全的
+        start = bisect.bisect_right(ids, pagination_token) if pagination_token else 0
+        if prefix:
+            start = max(start, bisect.bisect_left(ids, prefix))
+        page = ids[start:start + limit + 1]
+        if prefix:
+            page = list(itertools.takewhile(lambda cid: cid.startswith(prefix), page))
+        nxt = page[limit - 1] if len(page) > limit else None
+        page = page[:limit]
+        return types.SimpleNamespace(vectors=[types.SimpleNamespace(id=cid) for cid in page],
+                                     pagination=types.SimpleNamespace(next=nxt) if nxt else None,
+                                     namespace=namespace)
+
+    def describe_index_stats(self, **kwargs):
+        with self.lock:
+            counts = {}
+            for ns, _ in self.rows:
+                counts[ns] = counts.get(ns, 0) + 1
+        return types.SimpleNamespace(dimension=self.dim, total_vector_count=sum(counts.values()),
+                                     namespaces={ns: types.SimpleNamespace(vector_count=n) for ns, n in counts.items()})